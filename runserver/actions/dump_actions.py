@@ -31,6 +31,7 @@ if __name__ == '__main__':
                         {'$set':
                              {'timestamp': timestamp,
                               'parameters': value,
-                              'acted': 1}},
+                              'acted': 1,
+                              'updated': time.time()}},
                         upsert=True)
 
@@ -23,7 +23,7 @@ setuptools.setup(
         'more-itertools<6.0.0',
         'cherrypy<18.0.0',
         'mako',
-        'numpy>=1.6.1',
+        'numpy>=1.13',
         'scipy==1.1.0',
         'scikit-learn==0.20.3',
         'passlib>=1.6',
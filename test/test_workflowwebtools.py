@@ -5,6 +5,25 @@ import json
 import shutil
 import os
 import sys
+import time
+import ssl
+import tempfile
+import threading
+import subprocess
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    from importlib import reload
+except ImportError:
+    pass
 
 import cmstoolbox.webtools
 cmstoolbox.webtools.get_json = lambda *a, **k: {}
@@ -20,6 +39,8 @@ import update_history as uh
 import workflowwebtools.reasonsmanip as rm
 import workflowwebtools.manageactions as ma
 import workflowwebtools.globalerrors as ge
+import workflowwebtools.cachebackend as cb
+import workflowwebtools.workflowinfo as wi
 
 from workflowwebtools.paramsregression import convert_to_dense
 
@@ -77,6 +98,16 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(info.get_step_list('test2'), ['/test2/a/1'])
         self.assertFalse(info.get_step_list('test3'))
 
+    def test_duplicates(self):
+        import sqlite3
+        import workflowwebtools.errorutils as eu
+
+        curs = sqlite3.connect(':memory:').cursor()
+        eu.create_table(curs)
+
+        self.assertEqual(eu.add_to_database(curs, self.testdat), (6, 0))
+        self.assertEqual(eu.add_to_database(curs, self.testdat), (0, 6))
+
     def test_reset(self):
         info = ge.ErrorInfo(self.testdat)
         # Let's load the new one
@@ -87,6 +118,177 @@ class TestGlobalError(unittest.TestCase):
         self.assertEqual(info.get_step_list('test3'), ['/test3/test/2'])
         self.assertFalse(info.get_step_list('test1'))
 
+    def test_refresh(self):
+        global_info = ge.GLOBAL_INFO
+        ge.GLOBAL_INFO = ge.ErrorInfo(self.testdat)
+
+        try:
+            old_info = ge.GLOBAL_INFO
+            self.assertTrue(old_info.get_step_table('/test1/a/1'))
+            old_tables = old_info._step_tables
+            old_table = list(old_tables['/test1/a/1']['all'])
+
+            old_info.data_location = self.testdat.replace('.json', '2.json')
+            info = ge.rebuild_info()
+
+            # Anything that was still reading the old tables is not disturbed
+            self.assertEqual(old_tables['/test1/a/1']['all'], old_table)
+            self.assertIs(old_info._step_tables, old_tables)
+
+            self.assertEqual(info.get_step_list('test3'), ['/test3/test/2'])
+            self.assertFalse(info.get_step_list('test1'))
+            self.assertFalse(info.get_step_table('/test1/a/1'))
+            self.assertEqual(info.get_step_table('/test3/test/2'),
+                             [(errors, site, int(code)) for code, sites in
+                              sorted(self.read_testdat2()['/test3/test/2'].items())
+                              for site, errors in sorted(sites.items())])
+            self.assertEqual(info.get_allmap()['stepname'], ['/test3/test/2'])
+        finally:
+            ge.GLOBAL_INFO = global_info
+
+    def read_testdat2(self):
+        with open(self.testdat.replace('.json', '2.json'), 'r') as testdat:
+            return json.load(testdat)
+
+    def test_refresh_rollback(self):
+        import sqlite3
+
+        global_info = ge.GLOBAL_INFO
+        ge.GLOBAL_INFO = info = ge.ErrorInfo(self.testdat)
+        before = info.execute('SELECT * FROM workflows')
+        load_rows = ge.ErrorInfo.load_rows
+
+        try:
+            # The second new row is missing a column, so the rebuild fails
+            ge.ErrorInfo.load_rows = lambda self: before + [
+                ('/test9/a/1/1/sitea', '/test9/a/1', 1, 'sitea', 1, 'green'),
+                ('/test9/a/1/2/sitea', '/test9/a/1', 2, 'sitea', 1)]
+            self.assertRaises(sqlite3.Error, ge.rebuild_info)
+            ge.ErrorInfo.load_rows = load_rows
+
+            self.assertIs(ge.GLOBAL_INFO, info)
+            self.assertEqual(info.execute('SELECT * FROM workflows'), before)
+
+            # A rebuild that is already running is not started again
+            info.data_location = self.testdat.replace('.json', '2.json')
+            with ge.BUILD_LOCK:
+                self.assertIs(ge.rebuild_info(wait=False), info)
+            self.assertEqual(info.execute('SELECT * FROM workflows'), before)
+        finally:
+            ge.ErrorInfo.load_rows = load_rows
+            ge.GLOBAL_INFO = global_info
+
+    def test_shared_info(self):
+        global_info = ge.GLOBAL_INFO
+        ge.GLOBAL_INFO = ge.ErrorInfo(self.testdat)
+
+        try:
+            session1, session2 = {}, {}
+            old_info = ge.check_session(session1)
+            self.assertIs(ge.check_session(session2), old_info)
+            self.assertEqual(session1['timestamp'], old_info.timestamp)
+            self.assertTrue(old_info.get_step_table('/test1/a/1'))
+
+            old_info.data_location = self.testdat.replace('.json', '2.json')
+            new_info = ge.rebuild_info()
+
+            self.assertIsNot(new_info, old_info)
+            self.assertIs(ge.check_session(session1), new_info)
+
+            # The old ErrorInfo is left alone for anyone still reading it
+            self.assertEqual(old_info.get_step_list('test1'), ['/test1/a/1', '/test1/a/2'])
+            self.assertTrue(old_info.get_step_table('/test1/a/1'))
+
+            self.assertFalse(new_info.get_step_list('test1'))
+            self.assertFalse(new_info.get_step_table('/test1/a/1'))
+            self.assertEqual(new_info.get_step_list('test3'), ['/test3/test/2'])
+            self.assertEqual(new_info.get_allmap()['stepname'], ['/test3/test/2'])
+        finally:
+            ge.GLOBAL_INFO = global_info
+
+    def test_first_build(self):
+        global_info = ge.GLOBAL_INFO
+        ge.GLOBAL_INFO = None
+
+        try:
+            # Pages do not wait while another thread builds the first ErrorInfo
+            with ge.BUILD_LOCK:
+                info = ge.check_session({})
+                self.assertIsInstance(info, ge.EmptyErrorInfo)
+                self.assertEqual(info.return_workflows(), [])
+                self.assertIs(ge.rebuild_info(wait=False), info)
+                self.assertIsNone(ge.GLOBAL_INFO)
+
+            # Once the first one is shared, everyone gets it
+            ge.GLOBAL_INFO = ge.ErrorInfo(self.testdat)
+            self.assertIs(ge.shared_info(wait=False), ge.GLOBAL_INFO)
+        finally:
+            ge.GLOBAL_INFO = global_info
+
+    def test_collected(self):
+        import gc
+        import weakref
+
+        # An ErrorInfo is freed without the cycle collector,
+        # which cannot free objects with __del__ in Python 2
+        gc.disable()
+        try:
+            info = weakref.ref(ge.ErrorInfo(self.testdat))
+            self.assertIsNone(info())
+        finally:
+            gc.enable()
+
+    def test_matrix(self):
+        info = ge.ErrorInfo(self.testdat)
+        session = {'info': info}
+
+        for pievar in ['errorcode', 'sitename', 'stepname']:
+            rowname, colname = ge.get_row_col_names(pievar)
+            errors = ge.get_errors(pievar, session)
+
+            for row, col, pvar, numerrors in info.execute(
+                    'SELECT {0}, {1}, {2}, numbererrors FROM workflows'.format(
+                        rowname, colname, pievar)):
+                self.assertEqual(errors[row]['errors'][col][pvar], numerrors)
+                self.assertEqual(
+                    sorted(ge.list_matching_pievars(pievar, row, str(col), session)),
+                    sorted(info.execute('SELECT {0}, numbererrors FROM workflows '
+                                        'WHERE {1}=? AND {2}=?'.format(pievar, rowname, colname),
+                                        (row, col))))
+
+            for row, total in info.execute('SELECT {0}, SUM(numbererrors) FROM workflows '
+                                           'GROUP BY {0}'.format(rowname)):
+                self.assertEqual(errors[row]['total'], total)
+
+        # Rows are error codes 1 and 423, columns are sitea and siteb
+        self.assertEqual(ge.get_step_table('/test1/a/1', session), [[3, 2], [3, 2]])
+        self.assertEqual(ge.get_step_table('/test1/a/2', session), [[3, 0], [0, 0]])
+        self.assertEqual(ge.get_step_table('/test1/a/2', session,
+                                           allmap={'errorcode': [1], 'sitename': ['siteb', 'sitea']}),
+                         [[0, 3]])
+        readiness = [ready for ready, in info.execute('SELECT DISTINCT sitereadiness FROM workflows')]
+        self.assertEqual(ge.get_step_table('/test1/a/1', session, readymatch=readiness),
+                         [[3, 2], [3, 2]])
+        self.assertEqual(ge.get_step_table('/test1/a/1', session, readymatch=['not a status']),
+                         [[0, 0], [0, 0]])
+
+        self.assertFalse(ge.list_matching_pievars('errorcode', '/test1/a/1', 'nosite', session))
+
+    def test_see_workflow(self):
+        info = ge.ErrorInfo(self.testdat)
+        session = {'info': info}
+
+        workflowdata = ge.see_workflow('test1', session)
+        steplist = workflowdata['steplist']
+
+        self.assertEqual([step for step, _ in steplist], ['/test1/a/1', '/test1/a/2'])
+        for step, table in steplist:
+            self.assertEqual([row for row, _ in table], ge.get_step_table(step, session))
+            self.assertEqual([error for _, error in table], [1, 423])
+
+        self.assertEqual(workflowdata['skips']['/test1/a/1'], {'sites': set(), 'index': set()})
+        self.assertEqual(workflowdata['skips']['/test1/a/2'], {'sites': {'siteb'}, 'index': {1}})
+
 
 class TestClusteringAndReasons(unittest.TestCase):
 
@@ -143,12 +345,7 @@ class TestClusteringAndReasons(unittest.TestCase):
         ge.check_session(None).setup()
 
         for wkf in ge.check_session(None).return_workflows():
-            file_name = WorkflowInfo(wkf).cache_filename('workflow_params')
-            dirname = os.path.dirname(file_name)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            with open(file_name, 'w') as cache:
-                json.dump({}, cache)
+            WorkflowInfo(wkf).set_cached('workflow_params', {})
 
     def tearDown(self):
         os.remove(sc.workflow_history_path())
@@ -156,16 +353,19 @@ class TestClusteringAndReasons(unittest.TestCase):
             os.remove(sc.all_errors_path())
 
         for wkf in ge.check_session(None).return_workflows():
-            file_name = WorkflowInfo(wkf).cache_filename('workflow_params')
-            os.remove(file_name)
+            WorkflowInfo(wkf).reset()
 
         ge.check_session(None).teardown()
 
+        import workflowwebtools.clusterworkflows as cw
+        if os.path.exists(cw.model_path()):
+            os.remove(cw.model_path())
+
     def test_updatehistory(self):
         import workflowwebtools.globalerrors as ge
 
-        self.assertEqual(ge.ErrorInfo(sc.all_errors_path()).info[1:],
-                         ge.ErrorInfo(sc.workflow_history_path()).info[1:],
+        self.assertEqual(ge.ErrorInfo(sc.all_errors_path()).info,
+                         ge.ErrorInfo(sc.workflow_history_path()).info,
                          'Update workflow script did not create equivalent database')
 
     def test_clusterer(self):
@@ -179,6 +379,147 @@ class TestClusteringAndReasons(unittest.TestCase):
                              self.should_cluster[workflow],
                              'Clustering acting unexpectedly.')
 
+    def test_cluster_lookup(self):
+        import workflowwebtools.clusterworkflows as cw
+
+        # Nothing is clustered until it is done in the background
+        self.assertEqual(cw.get_cluster('test1'), [])
+
+        clusterer = cw.get_clusterer(sc.workflow_history_path())
+        groups = cw.get_workflow_groups(clusterer)
+
+        self.assertIs(ge.check_session(None).clusters, groups)
+        self.assertEqual(groups.version, clusterer['version'])
+        for workflow, similar in self.should_cluster.items():
+            self.assertEqual(cw.get_cluster(workflow), similar)
+
+        # Only a new clusterer replaces the groups
+        self.assertIs(cw.get_workflow_groups(clusterer), groups)
+        self.assertEqual(groups.without({'test2'}).group('test1'), [])
+
+    def test_neighbors(self):
+        import workflowwebtools.clusterworkflows as cw
+
+        neighbors = cw.get_neighbors()
+        self.assertIs(ge.check_session(None).neighbors, neighbors)
+
+        for workflow, similar in self.should_cluster.items():
+            found = cw.get_similar_workflows(workflow)
+            self.assertEqual(len(found), 2)
+            self.assertNotIn(workflow, [wf for wf, _ in found])
+            # Closest first
+            self.assertEqual([dist for _, dist in found], sorted(dist for _, dist in found))
+            if similar:
+                self.assertEqual(found[0][0], similar[0])
+
+        self.assertEqual(cw.get_similar_workflows('not_a_workflow'), [])
+
+        # Pages do not find neighbors, they are found before an ErrorInfo is shared
+        info = ge.ErrorInfo(ge.check_session(None).data_location)
+        self.assertEqual(cw.get_similar_workflows('test1', {'info': info}), [])
+        self.assertIsNone(info.neighbors)
+        ge.run_build_hooks(info)
+        self.assertEqual(info.neighbors, neighbors)
+
+    def test_minibatch(self):
+        import yaml
+        import sqlite3
+        import workflowwebtools.clusterworkflows as cw
+
+        config = sc.config_dict()
+        config['cluster']['mode'] = 'minibatch'
+        config['cluster']['batch_size'] = 2
+
+        location = sc.LOCATION
+        handle, sc.LOCATION = tempfile.mkstemp(suffix='.yml')
+
+        try:
+            with os.fdopen(handle, 'w') as config_file:
+                yaml.dump(config, config_file)
+
+            def last_row():
+                conn = sqlite3.connect(sc.workflow_history_path())
+                output = conn.execute('SELECT MAX(rowid) FROM workflows').fetchone()[0]
+                conn.close()
+                return output
+
+            clusterer = cw.get_clusterer(sc.workflow_history_path(), sc.all_errors_path())
+            self.assertEqual(clusterer['num_fit'], 3)
+            self.assertEqual(clusterer['last_row'], last_row())
+            # The errors path is not used, so it does not change the version
+            self.assertEqual(cw.load_clusterer(sc.workflow_history_path(), 'other.json')['version'],
+                             clusterer['version'])
+
+            # Only the workflow with new rows is added
+            new_errors = os.path.join(os.path.dirname(sc.all_errors_path()), 'new_errors.json')
+            with open(new_errors, 'w') as output:
+                json.dump({'/test1/b/1': {'2': {'site_b': 10}}}, output)
+
+            uh.main(new_errors)
+            os.remove(new_errors)
+
+            updated = cw.read_model()
+            self.assertEqual(updated['num_fit'], 4)
+            self.assertEqual(updated['last_row'], last_row())
+            self.assertEqual(updated['allmap'], clusterer['allmap'])
+            self.assertEqual(cw.get_clusterer(sc.workflow_history_path())['num_fit'], 4)
+
+            self.assertEqual(len(cw.get_workflow_groups(updated)), 3)
+
+        finally:
+            os.remove(sc.LOCATION)
+            sc.LOCATION = location
+
+    def test_saved_clusterer(self):
+        import numpy
+        import workflowwebtools.clusterworkflows as cw
+
+        clusterer = cw.get_clusterer(sc.workflow_history_path())
+        self.assertEqual(cw.load_clusterer(sc.workflow_history_path())['version'],
+                         clusterer['version'])
+
+        # Mark the saved clusterer to see that it is not fit again
+        saved = cw.read_model()
+        saved['marked'] = True
+        cw.save_model(saved)
+        self.assertTrue(cw.get_clusterer(sc.workflow_history_path()).get('marked'))
+
+        # New training data makes a new version, which starts from the old centroids
+        self.assertFalse(cw.load_clusterer(sc.workflow_history_path(), sc.all_errors_path()))
+        refit = cw.get_clusterer(sc.workflow_history_path(), sc.all_errors_path())
+
+        self.assertNotEqual(refit['version'], clusterer['version'])
+        self.assertFalse(refit.get('marked'))
+        self.assertEqual(cw.read_model()['version'], refit['version'])
+        numpy.testing.assert_allclose(
+            sorted(refit['clusterer'].cluster_centers_.tolist()),
+            sorted(clusterer['clusterer'].cluster_centers_.tolist()))
+
+    def test_clusterer_with_errors(self):
+        import sqlite3
+        import workflowwebtools.clusterworkflows as cw
+
+        def num_rows():
+            conn = sqlite3.connect(sc.workflow_history_path())
+            output = conn.execute('SELECT COUNT(*) FROM workflows').fetchone()[0]
+            conn.close()
+            return output
+
+        new_errors = os.path.join(os.path.dirname(sc.all_errors_path()), 'new_errors.json')
+        with open(new_errors, 'w') as output:
+            json.dump({'/test4/b/1': {'2': {'site_b': 10}}}, output)
+
+        try:
+            rows = num_rows()
+            clusterer = cw.get_clusterer(sc.workflow_history_path(), new_errors)
+
+            # The errors are not written into the history, so the saved model is still current
+            self.assertEqual(num_rows(), rows)
+            self.assertEqual(cw.load_clusterer(sc.workflow_history_path(), new_errors)['version'],
+                             clusterer['version'])
+        finally:
+            os.remove(new_errors)
+
     def test_steptable(self):
         # This isn't particularly well written,
         # but we should expect a table with
@@ -207,6 +548,37 @@ class TestClusteringAndReasons(unittest.TestCase):
                     self.assertEqual(error_table[e_index][s_index],
                                      self.errors[step].get(str(error), {}).get(site, 0))
 
+    def test_vectors(self):
+        import numpy
+        import workflowwebtools.clusterworkflows as cw
+
+        info = ge.check_session(None)
+        allmap = info.get_allmap()
+        workflows = info.return_workflows()
+        num_errors = len(allmap['errorcode'])
+
+        vectors = cw.get_workflow_vectors(workflows)
+        self.assertEqual(vectors.shape, (len(workflows), num_errors + len(allmap['sitename'])))
+
+        # Asking for fewer workflows, in another order, gives the same rows
+        numpy.testing.assert_allclose(cw.get_workflow_vectors(workflows[::-2]), vectors[::-2])
+
+        for workflow, vector in zip(workflows, vectors):
+            table = numpy.sum([ge.get_step_table(step) for step in info.get_step_list(workflow)],
+                              axis=0)
+
+            for column, raw, part in [('errorcode', table.sum(axis=1), vector[:num_errors]),
+                                      ('sitename', table.sum(axis=0), vector[num_errors:])]:
+                settings = sc.config_dict()['cluster'][column]
+                length = numpy.linalg.norm(raw)
+
+                # Points the same way as the errors, at the distance set by the config
+                numpy.testing.assert_allclose(part * length, raw * numpy.linalg.norm(part))
+                self.assertAlmostEqual(
+                    numpy.linalg.norm(part),
+                    settings['distance']/1.4142 +
+                    2.0 * settings['width'] * (length/(length + settings['midpoint']) - 0.5))
+
     def test_sparsetodense(self):
         dense = {}
         sparse = {}
@@ -220,6 +592,441 @@ class TestClusteringAndReasons(unittest.TestCase):
             self.assertEqual(dense[step], to_dense[step])
 
 
+class TestCacheBackend(unittest.TestCase):
+
+    db_name = 'test_cache.db'
+
+    def tearDown(self):
+        if os.path.exists(self.db_name):
+            os.remove(self.db_name)
+
+    def test_eviction(self):
+        memory = cb.MemoryCache(10)
+        memory.set('a', 0, 'a', 4)
+        memory.set('b', 0, 'b', 4)
+        # Using 'a' makes 'b' the one to evict
+        self.assertEqual(memory.get('a'), (0, 'a'))
+        memory.set('c', 0, 'c', 4)
+
+        self.assertEqual(memory.get('b'), None)
+        self.assertEqual(memory.get('c'), (0, 'c'))
+        self.assertEqual(memory.num_bytes, 8)
+
+    def test_two_tier(self):
+        cache = cb.TwoTierCache(cb.SQLiteStore(self.db_name), 1000)
+        cache.set('key', {'test': [1, 2]})
+
+        # Load from the store instead of memory
+        cache.memory.delete('key')
+        self.assertEqual(cache.get('key', 100), {'test': [1, 2]})
+        self.assertEqual(cache.get('key', -1), None)
+
+        cache.delete('key')
+        self.assertEqual(cache.get('key'), None)
+
+    def test_compressed(self):
+        directory = tempfile.mkdtemp()
+
+        try:
+            cb.TwoTierCache(cb.FileStore(directory), 1000).set('key', {'test': [1, 2]})
+            plain = cb.FileStore(directory).filename('key')
+
+            # Plain files are still read, and replaced when set again
+            cache = cb.TwoTierCache(cb.FileStore(directory, compressed=True), 1000)
+            self.assertEqual(cache.get('key'), {'test': [1, 2]})
+
+            cache.set('key', {'test': [3]})
+            self.assertFalse(os.path.exists(plain))
+            cache.memory.delete('key')
+            self.assertEqual(cache.get('key'), {'test': [3]})
+
+            with open(cache.store.filename('key'), 'rb') as compressed:
+                self.assertEqual(cb.decompress(compressed.read()), '{"test": [3]}')
+
+            cache.delete('key')
+            self.assertEqual(cache.get('key'), None)
+
+        finally:
+            shutil.rmtree(directory)
+
+        store = cb.SQLiteStore(self.db_name)
+        store.save('plain', '{}')
+        store.compressed = True
+        store.save('compressed', '{"test": 1}')
+
+        self.assertEqual(store.load('plain')[1], '{}')
+        self.assertEqual(store.load('compressed')[1], '{"test": 1}')
+
+    def test_expire(self):
+        store = cb.SQLiteStore(self.db_name)
+        store.save('old', '{}')
+        store.conn.execute('UPDATE cache SET timestamp=? WHERE key=?',
+                           (time.time() - 7200, 'old'))
+        store.save('new', '{}')
+
+        self.assertEqual(store.expire(3600), 1)
+        self.assertEqual(store.load('old'), None)
+        self.assertEqual(store.load('new')[1], '{}')
+
+        self.assertEqual(store.expire(), 1)
+        self.assertEqual(store.load('new'), None)
+
+
+class TestFileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = cb.FileStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_write(self):
+        self.store.save('key', '{"old": 1}')
+
+        class NotText(object):
+            pass
+
+        # A write that fails leaves the old file, and no temporary file
+        self.assertRaises(TypeError, self.store.save, 'key', NotText())
+        self.assertEqual(self.store.load('key')[1], '{"old": 1}')
+        self.assertEqual(sorted(os.listdir(self.directory)), ['.lock', 'key.cache.json'])
+
+    def test_expire(self):
+        self.store.save('old', '{}')
+        self.store.save('new', '{}')
+        with open(os.path.join(self.directory, 'crashed.tmp'), 'w') as temp:
+            temp.write('{')
+
+        past = time.time() - 7200
+        for name in ['old.cache.json', 'crashed.tmp']:
+            os.utime(os.path.join(self.directory, name), (past, past))
+
+        self.assertEqual(self.store.expire(3600), 2)
+        self.assertEqual(self.store.load('old'), None)
+        self.assertEqual(self.store.load('new')[1], '{}')
+
+        self.assertEqual(self.store.expire(), 1)
+        self.assertEqual(os.listdir(self.directory), ['.lock'])
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_single_flight(self):
+        import workflowwebtools.concurrency as cc
+
+        flight = cc.SingleFlight()
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+        results = []
+
+        def compute(key):
+            calls.append(key)
+            started.set()
+            finish.wait(10)
+            return len(calls)
+
+        def request(key):
+            results.append(flight.do(key, compute, key))
+
+        threads = [threading.Thread(target=request, args=('a',)) for _ in range(5)]
+        threads[0].start()
+        started.wait(10)
+        for thread in threads[1:]:
+            thread.start()
+
+        # A different key does not wait
+        self.assertEqual(flight.do('b', lambda: 'b'), 'b')
+
+        finish.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, [1] * 5)
+
+        # Errors are raised, and the key can run again
+        self.assertRaises(ValueError, flight.do, 'a', int, 'not a number')
+        self.assertEqual(flight.do('a', int, '2'), 2)
+
+    def test_keyed_locks(self):
+        import workflowwebtools.concurrency as cc
+
+        locks = cc.KeyedLocks()
+        order = []
+
+        def other_submit():
+            with locks.hold(['a']):
+                order.append('other')
+
+        with locks.hold(['b', 'a']):
+            other = threading.Thread(target=other_submit)
+            other.start()
+            other.join(0.2)
+            # Waits on 'a', while 'c' is free
+            with locks.hold(['c']):
+                order.append('c')
+            order.append('main')
+
+        other.join(10)
+        self.assertEqual(order, ['c', 'main', 'other'])
+        # Nothing is left once the locks are free
+        self.assertFalse(locks._locks)
+
+
+class TestSharedFetch(unittest.TestCase):
+
+    def test_one_fetch(self):
+        calls = []
+        started = threading.Event()
+        finish = threading.Event()
+
+        class SlowInfo(wi.Info):
+            def __str__(self):
+                return 'slowinfo_test'
+
+            @wi.cached_json('slow', timeout=100)
+            def get_slow(self):
+                calls.append(self)
+                started.set()
+                finish.wait(10)
+                return {'calls': len(calls)}
+
+        results = []
+        # Separate objects, like the ones made before they were shared
+        infos = [object.__new__(SlowInfo) for _ in range(4)]
+        threads = [threading.Thread(target=lambda info=info: results.append(info.get_slow()))
+                   for info in infos]
+
+        try:
+            threads[0].start()
+            started.wait(10)
+            for thread in threads[1:]:
+                thread.start()
+
+            # Let the others reach the fetch in flight
+            time.sleep(0.1)
+            finish.set()
+            for thread in threads:
+                thread.join(10)
+
+            # Separate objects for the same key only fetch once
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, [{'calls': 1}] * 4)
+        finally:
+            cb.get_backend().delete(infos[0].cache_key('slow'))
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_same_object(self):
+        info = WorkflowInfo('registry_workflow')
+
+        self.assertIs(WorkflowInfo('registry_workflow'), info)
+        self.assertIs(WorkflowInfo('registry_workflow', url='cmsweb.cern.ch'), info)
+        self.assertIsNot(WorkflowInfo('registry_workflow', 'localhost'), info)
+        self.assertIsNot(wi.PrepIDInfo('registry_workflow'), info)
+
+        # Asking again does not set it up again
+        info.explanations = {}
+        self.assertEqual(WorkflowInfo('registry_workflow').explanations, {})
+        self.assertRaises(AttributeError, setattr, info, 'not_a_slot', None)
+
+        # Nothing is kept after the last reference is gone
+        key = (WorkflowInfo, 'registry_workflow', 'cmsweb.cern.ch')
+        self.assertIn(key, wi.Info._registry)
+        del info
+        self.assertNotIn(key, wi.Info._registry)
+
+
+class TestExplanations(unittest.TestCase):
+
+    workflow = 'explain_workflow'
+
+    def jobdetail(self, details, count=1):
+        return {'result': [{self.workflow: {'step': {'jobfailed': {'8001': {'T2_US_MIT': {
+            'errorCount': count,
+            'samples': [{'errors': {'cmsRun1': [
+                {'type': 'Fatal Exception', 'exitCode': 8001, 'details': details}
+            ]}}]
+        }}}}}}]}
+
+    def setUp(self):
+        self.info = WorkflowInfo(self.workflow)
+        self.info.set_cached('jobdetail', self.jobdetail('first'))
+
+    def tearDown(self):
+        self.info.reset()
+
+    def test_parse_once(self):
+        self.assertTrue(self.info.get_explanation('8001')[0].endswith('first'))
+        explanations = self.info.explanations
+
+        # Loading the same document again from the store does not parse it again
+        cb.get_backend().memory.delete(self.info.cache_key('jobdetail'))
+        self.info.get_explanation('8001')
+        self.assertTrue(self.info.explanations is explanations)
+
+        time.sleep(0.05)
+        self.info.set_cached('jobdetail', self.jobdetail('second'))
+        self.assertTrue(self.info.get_explanation('8001')[0].endswith('second'))
+
+    def test_errors_follow_jobdetail(self):
+        self.info.set_cached('acdc', {'rows': []})
+        self.assertEqual(self.info.get_errors(True), {'step': {'8001': {'T2_US_MIT': 1}}})
+
+        # The errors always come from the same jobdetail as the explanations
+        self.info.set_cached('jobdetail', self.jobdetail('second', 3))
+        self.assertEqual(self.info.get_errors(True), {'step': {'8001': {'T2_US_MIT': 3}}})
+        self.assertTrue(self.info.get_explanation('8001')[0].endswith('second'))
+
+
+class StubCmsweb(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubCmswebHandler(BaseHTTPRequestHandler):
+    """Answers ReqMgr2 and wmstats requests for the test in self.server.test"""
+
+    def do_GET(self):
+        test = self.server.test
+        url = urlparse(self.path)
+
+        with test.lock:
+            test.calls.append(url.path)
+            test.in_flight += 1
+            test.max_in_flight = max(test.max_in_flight, test.in_flight)
+            if test.in_flight == test.threads:
+                test.all_in_flight.set()
+
+        # Hold every request until the whole pool is waiting at once
+        test.all_in_flight.wait(10)
+
+        with test.lock:
+            test.in_flight -= 1
+
+        if url.path == '/reqmgr2/data/request':
+            body = {'result': [{name: {'PrepID': 'prep_%s' % name}
+                                for name in parse_qs(url.query)['name']}]}
+        else:
+            name = url.path.split('/')[-1]
+            body = {'result': [{name: {'RequestStatus': 'running-closed'}}]}
+
+        text = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrefetch(unittest.TestCase):
+
+    workflows = ['prefetch_workflow_%i' % i for i in range(20)]
+
+    @classmethod
+    def setUpClass(cls):
+        # get_json is replaced when the test modules are imported, so load it again
+        cls.get_json = staticmethod(reload(cmstoolbox.webtools).get_json)
+        cmstoolbox.webtools.get_json = lambda *a, **k: {}
+
+        # The requests are made over HTTPS with a certificate, like to cmsweb
+        cls.cert_dir = tempfile.mkdtemp()
+        cls.pem = os.path.join(cls.cert_dir, 'stub.pem')
+        key = os.path.join(cls.cert_dir, 'key.pem')
+        cert = os.path.join(cls.cert_dir, 'cert.pem')
+
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                                   '-subj', '/CN=localhost', '-days', '1',
+                                   '-keyout', key, '-out', cert],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.cert_dir)
+            raise unittest.SkipTest('Cannot make a certificate for the stub server')
+
+        with open(cls.pem, 'w') as pem:
+            for name in [key, cert]:
+                with open(name, 'r') as part:
+                    pem.write(part.read())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cert_dir)
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.all_in_flight = threading.Event()
+        self.threads = 1
+
+        self.server = StubCmsweb(('localhost', 0), StubCmswebHandler)
+        self.server.test = self
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(self.pem)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.proxy = os.environ.get('X509_USER_PROXY')
+        os.environ['X509_USER_PROXY'] = self.pem
+
+        self.stub_get_json = wi.get_json
+        wi.get_json = self.get_json
+
+        url = 'localhost:%i' % self.server.server_address[1]
+        self.infos = [WorkflowInfo(wkf, url) for wkf in self.workflows]
+        for info in self.infos:
+            info.reset()
+
+    def tearDown(self):
+        wi.get_json = self.stub_get_json
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        if self.proxy is None:
+            os.environ.pop('X509_USER_PROXY')
+        else:
+            os.environ['X509_USER_PROXY'] = self.proxy
+
+        for info in self.infos:
+            info.reset()
+
+    def test_prefetch(self):
+        self.threads = 4
+        wi.prefetch(self.infos, ['reqdetail', 'not_an_attribute'], threads=self.threads)
+
+        self.assertEqual(len(self.calls), len(self.workflows))
+        # The pool filled up, and never went past its size
+        self.assertTrue(self.all_in_flight.is_set())
+        self.assertEqual(self.max_in_flight, self.threads)
+
+        # Everything should now come from the cache
+        for info in self.infos:
+            self.assertEqual(info._get_reqdetail()[info.workflow]['RequestStatus'],
+                             'running-closed')
+        self.assertEqual(len(self.calls), len(self.workflows))
+
+    def test_parameters(self):
+        wi.prefetch(self.infos, ['workflow_params'])
+
+        # One request for every 50 workflows
+        self.assertEqual(self.calls, ['/reqmgr2/data/request'])
+
+        for info in self.infos:
+            self.assertEqual(info.get_prep_id(), 'prep_%s' % info.workflow)
+        self.assertEqual(len(self.calls), 1)
+
+
 class TestReasons(unittest.TestCase):
 
     reasons = [
@@ -256,6 +1063,46 @@ class TestReasons(unittest.TestCase):
                          'Reasons list return is not same as sent,\n\n%s\n\n%s' %
                          (rm.reasons_list(), {reas['short']: reas['long'] for reas in self.reasons}))
 
+    def test_store(self):
+        store = rm.get_store()
+        self.assertIs(rm.get_store(), store)
+
+        # Returned lists can be changed without touching the cache
+        rm.reasons_list().clear()
+        self.assertEqual(len(rm.reasons_list()), len(self.reasons))
+
+        # Existing long reasons are kept, and bad lists write nothing
+        self.assertRaises(KeyError, rm.update_reasons,
+                          [{'short': 'short reason 3', 'long': 'new'}, {'wrong': 'key'}])
+        rm.update_reasons([{'short': 'short reason 1', 'long': 'changed'},
+                           {'short': rm.DEFAULT_SHORT, 'long': 'not saved'}])
+        self.assertEqual(rm.reasons_list(),
+                         {reas['short']: reas['long'] for reas in self.reasons})
+
+        # Another process writing or removing the file is noticed
+        other = rm.ReasonsStore(store.file_name)
+        other.update([('short reason 3', 'from elsewhere')])
+        self.assertEqual(rm.reasons_list()['short reason 3'], 'from elsewhere')
+
+        os.remove(store.file_name)
+        self.assertEqual(rm.reasons_list(), {})
+
+
+class TestMongoClient(unittest.TestCase):
+
+    def test_shared_client(self):
+        client = ma.get_client()
+        self.assertIs(ma.get_client(), client)
+
+        # A forked process makes its own
+        pid = ma.CLIENT_PID
+        ma.CLIENT_PID = -1
+        try:
+            self.assertIsNot(ma.get_client(), client)
+            self.assertEqual(ma.CLIENT_PID, pid)
+        finally:
+            ma.CLIENT = client
+
 
 class TestActions(unittest.TestCase):
 
@@ -294,19 +1141,15 @@ class TestActions(unittest.TestCase):
             print('Test database not empty, abort!!')
             exit(123)
 
-        file_name = WorkflowInfo(self.request_base['workflows']).cache_filename('workflow_params')
-        dirname = os.path.dirname(file_name)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with open(file_name, 'w') as cache:
-            json.dump({}, cache)
+        WorkflowInfo(self.request_base['workflows']).set_cached('workflow_params', {})
 
     def tearDown(self):
         os.remove('reasons.db')
         ma.get_actions_collection().drop()
-
-        file_name = WorkflowInfo(self.request_base['workflows']).cache_filename('workflow_params')
-        os.remove(file_name)
+        # The indexes go with the collection
+        ma.INDEXED.clear()
+        ma.STATUSES.clear()
+        WorkflowInfo(self.request_base['workflows']).reset()
 
     def run_test(self, request, params_out):
 
@@ -345,6 +1188,78 @@ class TestActions(unittest.TestCase):
                 })
         self.run_test(request, {'test': 'test_param'})
 
+    def test_submit2(self):
+        workflow = self.request_base['workflows']
+        documents = [{'workflow': workflow, 'parameters': {'Action': 'clone'}},
+                     {'workflow': 'other_workflow', 'parameters': {'Action': 'clone'}}]
+
+        self.assertEqual(ma.submit2(documents[:1]), {workflow: 'inserted'})
+
+        # The last action for a workflow is the one kept
+        documents.append({'workflow': workflow, 'parameters': {'Action': 'special'}})
+        self.assertEqual(ma.submit2(documents),
+                         {workflow: 'updated', 'other_workflow': 'inserted'})
+        self.assertEqual(ma.get_actions()[workflow], {'Action': 'special'})
+        self.assertEqual(ma.get_actions_collection().count(), 2)
+
+    def test_failed_write(self):
+        request = self.extend_request({
+                'action': 'clone',
+                'param_0_test': 'test_param'
+                })
+
+        write_actions = ma.write_actions
+        ma.write_actions = lambda actions: {workflow: 'E11000 duplicate key error'
+                                            for workflow, _ in actions}
+        try:
+            with self.assertRaises(ma.FailedWrite) as context:
+                ma.submitaction('test', **request)
+        finally:
+            ma.write_actions = write_actions
+
+        self.assertEqual(context.exception.failures,
+                         {self.request_base['workflows']: 'E11000 duplicate key error'})
+
+    def test_changes_since(self):
+        ma.submit2([{'workflow': 'first_workflow', 'parameters': {}}])
+        first = ma.changes_since()
+        self.assertEqual([(change['workflow'], change['acted']) for change in first],
+                         [('first_workflow', 0)])
+
+        ma.submit2([{'workflow': 'second_workflow', 'parameters': {}}])
+        self.assertEqual([change['workflow'] for change in
+                          ma.changes_since(first[0]['updated'])], ['second_workflow'])
+
+        # Reporting an action is a change too
+        ma.report_actions(['first_workflow'])
+        self.assertEqual(sorted((change['workflow'], change['acted']) for change in ma.changes_since()),
+                         [('first_workflow', 1), ('second_workflow', 0)])
+        self.assertIn('acted_timestamp', ma.get_actions_collection().index_information())
+
+    def test_status_cache(self):
+        ma.submit2([{'workflow': 'first_workflow', 'parameters': {}}])
+        self.assertEqual(ma.STATUSES.get('first_workflow'), 0)
+        self.assertEqual(ma.STATUSES.get('not_a_workflow'), None)
+
+        # Writes from this process show up right away
+        ma.report_actions(['first_workflow'])
+        self.assertEqual(ma.STATUSES.get('first_workflow'), 1)
+
+        # Writes from other processes show up after the next poll
+        ma.get_actions_collection().update_one(
+            {'workflow': 'first_workflow'}, {'$set': {'acted': 0, 'updated': time.time()}})
+        self.assertEqual(ma.STATUSES.get('first_workflow'), 1)
+        ma.STATUSES.poll()
+        self.assertEqual(ma.STATUSES.get('first_workflow'), 0)
+
+        # So do writes stamped a little before the last change seen
+        ma.get_actions_collection().update_one(
+            {'workflow': 'first_workflow'}, {'$set': {'acted': 1, 'updated': time.time() - 60}})
+        ma.STATUSES.poll()
+        self.assertEqual(ma.STATUSES.get('first_workflow'), 1)
+
+        self.assertEqual(ma.get_acted_workflows(1), ['first_workflow'])
+
 class TestBlankReasons(TestActions):
     def test_blank_short(self):
         request = {
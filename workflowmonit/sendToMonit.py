@@ -203,6 +203,7 @@ def buildDoc(configpath):
 
     logger.info('Number of workflows to query: {}'.format(len(wkfs)))
 
+    # Only drop what is too old for the web server sharing the directory to use
     wc.invalidate_caches('/tmp/wsi/workflowinfo')
 
     q = TimeoutQueue()
@@ -6,7 +6,6 @@ import re
 import sys
 import json
 import time
-import shutil
 import threading
 from collections import defaultdict
 
@@ -14,6 +13,7 @@ import yaml
 import cx_Oracle
 from workflowwebtools import workflowinfo
 from workflowwebtools import errorutils
+from workflowwebtools import cachebackend
 
 
 def save_json(json_obj, filename='tmp'):
@@ -51,24 +51,26 @@ def get_yamlconfig(configPath):
 
 def invalidate_caches(cacheDir=None):
     '''
-    remove json caches pointed by cacheDir
+    remove json caches pointed by cacheDir that are too old to be used,
+    from the store set by ``cache_backend`` in the server configuration.
+    only caches older than the longest time under ``cache_refresh`` are removed,
+    so anything that the web server sharing the directory still uses is kept.
+    if no time is set there, nothing is removed.
 
-    :param str cache_dir: path of caching directory
+    :param str cacheDir: path of caching directory
     :returns: None
     '''
 
-    cache_dir = cacheDir or os.path.join(
-        os.environ.get('TMPDIR', '/tmp'), 'workflowinfo')
+    cache_dir = cacheDir or cachebackend.cache_dir()
+    max_age = cachebackend.longest_refresh()
 
-    try:
-        shutil.rmtree(cache_dir)
-    except:
-        print('Fail to remove caches: ', cache_dir)
-        pass
+    if max_age is None:
+        return
 
     try:
-        os.mkdir(cache_dir)
+        cachebackend.make_store(cache_dir).expire(max_age)
     except:
+        print('Fail to remove caches: ', cache_dir)
         pass
 
 
@@ -284,8 +286,7 @@ def error_logs(workflow):
         )
     )
 
-    wf_jobdetail = workflow._get_jobdetail()
-    wf_stepinfo = wf_jobdetail['result'][0].get(workflow.workflow, {})
+    wf_stepinfo = workflow.get_jobdetail()
 
     if not wf_stepinfo:
         return error_logs
@@ -0,0 +1,600 @@
+"""
+Storage behind the :py:func:`workflowinfo.cached_json` decorator.
+
+Each cached value is stored under a key made from the
+:py:class:`workflowinfo.Info` object and the name of the cached attribute.
+A single :py:class:`TwoTierCache` is shared by every object in the process.
+It keeps the most recently used values in memory, up to ``cache_memory``
+megabytes of JSON, in front of a persistent store.
+The persistent store is chosen by ``cache_backend`` in ``config.yml``:
+
+- ``file`` -- One JSON file per key in the cache directory (the default)
+- ``sqlite`` -- All keys in a single SQLite database in the cache directory
+
+If ``cache_format`` is ``zlib``, the JSON is compressed before it is stored.
+Values that were stored uncompressed are still read, and are replaced
+the next time they are set.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import sqlite3
+import tempfile
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import serverconfig
+
+
+def cache_dir():
+    """
+    :returns: The directory that holds the persistent cache
+    :rtype: str
+    """
+
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'workflowinfo')
+
+
+def longest_refresh():
+    """
+    :returns: The longest time in seconds that any cached value is used for,
+              set under ``cache_refresh`` in the server configuration,
+              or ``None`` if no time is set
+    :rtype: int
+    """
+
+    timeouts = [timeout for timeout in
+                (serverconfig.config_dict().get('cache_refresh') or {}).values() if timeout]
+
+    return max(timeouts) if timeouts else None
+
+
+def compress(text):
+    """
+    :param str text: JSON to compress
+    :returns: The compressed JSON
+    :rtype: bytes
+    """
+
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decompress(data):
+    """
+    :param bytes data: Output of :py:func:`compress`
+    :returns: The original JSON
+    :rtype: str
+    """
+
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+class MemoryCache(object):
+    """
+    A least recently used cache that is bounded by the total size
+    of the JSON that its values were loaded from.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param int max_bytes: The maximum number of bytes to hold before evicting
+        """
+
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # Values are tuples of (timestamp, value, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param str key: The key to look up
+        :returns: The timestamp and value stored, or ``None`` if not in memory
+        :rtype: tuple
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            # Move to the most recently used end
+            self._entries[key] = entry
+
+        return entry[:2]
+
+    def set(self, key, timestamp, value, size):
+        """
+        Store a value, and evict the least recently used entries until
+        the cache is within its size limit.
+
+        :param str key: The key to store the value under
+        :param float timestamp: The time that the value was fetched
+        :param value: The value to store
+        :param int size: The size in bytes of the value's JSON
+        """
+
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (timestamp, value, size)
+            self.num_bytes += size
+
+            while self.num_bytes > self.max_bytes:
+                _, (_, _, dropped) = self._entries.popitem(last=False)
+                self.num_bytes -= dropped
+
+    def delete(self, key):
+        """
+        :param str key: The key to remove from memory
+        """
+
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        """Remove a key. The lock must be held by the caller."""
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[2]
+
+
+class FileStore(object):
+    """
+    Persistent store with one JSON file per key.
+    Compressed files end in ``.cache.json.z``.
+
+    Files are written under a temporary name and then renamed,
+    so a reader never sees half of a file.
+    Changes to the directory hold a lock on its ``.lock`` file,
+    so that more than one process can share the same directory.
+    """
+
+    def __init__(self, directory, compressed=False):
+        """
+        :param str directory: The directory to store the files in
+        :param bool compressed: If True, new files are compressed
+        """
+
+        self.directory = directory
+        self.bak_dir = os.path.join(directory, 'bak')
+        self.compressed = compressed
+
+    def filename(self, key, compressed=None):
+        """
+        :param str key: The key of a cached value
+        :param bool compressed: Whether to give the name of the compressed file.
+                                The default is the format that new files are saved in.
+        :returns: The full name of the file holding the value
+        :rtype: str
+        """
+
+        if compressed is None:
+            compressed = self.compressed
+
+        return os.path.join(self.directory,
+                            '%s.cache.json%s' % (key, '.z' if compressed else ''))
+
+    def filenames(self, key):
+        """
+        :param str key: The key of a cached value
+        :returns: The names of the files that could hold the value,
+                  with the format that new files are saved in first
+        :rtype: list
+        """
+
+        return [self.filename(key, compressed) for compressed in
+                (self.compressed, not self.compressed)]
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the lock of the directory, which is shared with other processes
+        """
+
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self, key):
+        """
+        :param str key: The key to load
+        :returns: The modification time and contents of the file,
+                  or ``None`` if there is no file
+        :rtype: tuple
+        """
+
+        for file_name in self.filenames(key):
+            try:
+                mtime = os.stat(file_name).st_mtime
+                if file_name.endswith('.z'):
+                    with open(file_name, 'rb') as cache_file:
+                        return mtime, decompress(cache_file.read())
+
+                with open(file_name, 'r') as cache_file:
+                    return mtime, cache_file.read()
+            except (IOError, OSError):
+                pass
+            except zlib.error:
+                return mtime, ''
+
+        return None
+
+    def timestamp(self, key):
+        """
+        :param str key: The key to check
+        :returns: The modification time of the file, or ``None`` if there is no file
+        :rtype: float
+        """
+
+        for file_name in self.filenames(key):
+            try:
+                return os.stat(file_name).st_mtime
+            except OSError:
+                pass
+
+        return None
+
+    def save(self, key, text):
+        """
+        :param str key: The key to save under
+        :param str text: The JSON to write
+        :returns: The modification time of the new file
+        :rtype: float
+        """
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Made by another process in the meantime
+                pass
+
+        handle, temp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            if self.compressed:
+                with os.fdopen(handle, 'wb') as cache_file:
+                    cache_file.write(compress(text))
+            else:
+                with os.fdopen(handle, 'w') as cache_file:
+                    cache_file.write(text)
+
+            # Same permissions as a file opened normally
+            os.chmod(temp_name, 0o644)
+
+            with self.locked():
+                os.rename(temp_name, self.filename(key))
+
+                # Do not leave the value in the other format
+                old_name = self.filename(key, not self.compressed)
+                if os.path.exists(old_name):
+                    os.remove(old_name)
+
+        except Exception:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+        return self.timestamp(key)
+
+    def discard(self, key):
+        """
+        Remove a file that could not be read.
+
+        :param str key: The key to remove
+        """
+
+        if not os.path.exists(self.directory):
+            return
+
+        with self.locked():
+            for file_name in self.filenames(key):
+                if os.path.exists(file_name):
+                    print('JSON file no good. Deleting %s. Try again later.' % file_name)
+                    os.remove(file_name)
+
+    def delete(self, key):
+        """
+        Move a file into the backup directory.
+
+        :param str key: The key to remove
+        """
+
+        if not os.path.exists(self.directory):
+            return
+
+        with self.locked():
+            for file_name in self.filenames(key):
+                if os.path.exists(file_name):
+                    if not os.path.exists(self.bak_dir):
+                        os.makedirs(self.bak_dir)
+
+                    os.rename(file_name, file_name.replace(self.directory, self.bak_dir))
+
+    def expire(self, max_age=None):
+        """
+        Remove old files from the directory, without disturbing any process using it.
+        Temporary files left by a process that died while writing are removed too.
+
+        :param int max_age: Only remove files older than this many seconds.
+                            If ``None``, every cached value is removed.
+        :returns: The number of files removed
+        :rtype: int
+        """
+
+        if not os.path.exists(self.directory):
+            return 0
+
+        now = time.time()
+        removed = 0
+
+        with self.locked():
+            for name in os.listdir(self.directory):
+                if name.endswith('.tmp'):
+                    # Files still being written are left alone
+                    age = max(max_age or 0, 3600)
+                elif '.cache.json' in name:
+                    age = max_age
+                else:
+                    continue
+
+                file_name = os.path.join(self.directory, name)
+                try:
+                    if age is None or os.stat(file_name).st_mtime < now - age:
+                        os.remove(file_name)
+                        removed += 1
+                except OSError:
+                    pass
+
+        return removed
+
+
+class SQLiteStore(object):
+    """
+    Persistent store with every key in one SQLite database.
+    Compressed values are stored as blobs.
+    """
+
+    def __init__(self, file_name, compressed=False):
+        """
+        :param str file_name: The location of the database
+        :param bool compressed: If True, new values are compressed
+        """
+
+        self.file_name = file_name
+        self.compressed = compressed
+        self.conn = sqlite3.connect(file_name, check_same_thread=False, timeout=60)
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                              '(key varchar(1023) PRIMARY KEY, '
+                              'timestamp real, value text)')
+            self.conn.commit()
+
+    def load(self, key):
+        """
+        :param str key: The key to load
+        :returns: The time the value was saved and the stored JSON,
+                  or ``None`` if the key is not stored
+        :rtype: tuple
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT timestamp, value FROM cache WHERE key=?',
+                                    (key,)).fetchone()
+
+        # Text is read back as unicode, and blobs are not
+        if row is None or isinstance(row[1], type(u'')):
+            return row
+
+        try:
+            return row[0], decompress(row[1])
+        except zlib.error:
+            return row[0], ''
+
+    def timestamp(self, key):
+        """
+        :param str key: The key to check
+        :returns: The time the value was saved, or ``None`` if the key is not stored
+        :rtype: float
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT timestamp FROM cache WHERE key=?',
+                                    (key,)).fetchone()
+
+        return row and row[0]
+
+    def save(self, key, text):
+        """
+        :param str key: The key to save under
+        :param str text: The JSON to store
+        :returns: The time stored with the value
+        :rtype: float
+        """
+
+        timestamp = time.time()
+        value = sqlite3.Binary(compress(text)) if self.compressed else text
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO cache VALUES (?,?,?)',
+                              (key, timestamp, value))
+            self.conn.commit()
+
+        return timestamp
+
+    def delete(self, key):
+        """
+        :param str key: The key to remove
+        """
+
+        with self.lock:
+            self.conn.execute('DELETE FROM cache WHERE key=?', (key,))
+            self.conn.commit()
+
+    discard = delete
+
+    def expire(self, max_age=None):
+        """
+        Remove old values from the database.
+
+        :param int max_age: Only remove values older than this many seconds.
+                            If ``None``, every cached value is removed.
+        :returns: The number of values removed
+        :rtype: int
+        """
+
+        with self.lock:
+            if max_age is None:
+                removed = self.conn.execute('DELETE FROM cache').rowcount
+            else:
+                removed = self.conn.execute('DELETE FROM cache WHERE timestamp<?',
+                                            (time.time() - max_age,)).rowcount
+            self.conn.commit()
+
+        return removed
+
+
+class TwoTierCache(object):
+    """
+    A :py:class:`MemoryCache` in front of a persistent store
+    """
+
+    def __init__(self, store, max_bytes):
+        """
+        :param store: Either a :py:class:`FileStore` or :py:class:`SQLiteStore`
+        :param int max_bytes: The size limit of the memory cache
+        """
+
+        self.store = store
+        self.memory = MemoryCache(max_bytes)
+
+    def get(self, key, timeout=None):
+        """
+        :param str key: The key of the cached value
+        :param int timeout: The maximum age of the value in seconds.
+                            If ``None``, the value never expires.
+        :returns: The cached value, or ``None`` if missing or expired
+        """
+
+        oldest = None if timeout is None else time.time() - timeout
+
+        entry = self.memory.get(key)
+
+        if entry is None:
+            stored = self.store.load(key)
+            if stored is None:
+                return None
+
+            timestamp, text = stored
+            if oldest is not None and timestamp <= oldest:
+                return None
+
+            try:
+                value = json.loads(text)
+            except ValueError:
+                self.store.discard(key)
+                return None
+
+            self.memory.set(key, timestamp, value, len(text))
+            entry = (timestamp, value)
+
+        timestamp, value = entry
+        if oldest is not None and timestamp <= oldest:
+            return None
+
+        return value
+
+    def timestamp(self, key, timeout=None):
+        """
+        Get the time a value was stored without loading it.
+        This changes whenever the value is set again.
+
+        :param str key: The key of the cached value
+        :param int timeout: The maximum age of the value in seconds
+        :returns: The time the value was stored, or ``None`` if missing or expired
+        :rtype: float
+        """
+
+        entry = self.memory.get(key)
+        timestamp = self.store.timestamp(key) if entry is None else entry[0]
+
+        if timestamp is None or \
+                (timeout is not None and timestamp <= time.time() - timeout):
+            return None
+
+        return timestamp
+
+    def set(self, key, value):
+        """
+        :param str key: The key to store the value under
+        :param value: An object that can be written as JSON
+        """
+
+        text = json.dumps(value)
+        timestamp = self.store.save(key, text)
+        self.memory.set(key, timestamp, value, len(text))
+
+    def delete(self, key):
+        """
+        :param str key: The key to remove from both tiers
+        """
+
+        self.memory.delete(key)
+        self.store.delete(key)
+
+
+def make_store(directory=None):
+    """
+    :param str directory: The directory holding the persistent cache.
+                          If ``None``, :py:func:`cache_dir` is used.
+    :returns: The persistent store set by ``cache_backend`` and ``cache_format``
+              in the server configuration
+    :rtype: FileStore or SQLiteStore
+    """
+
+    config = serverconfig.config_dict()
+    directory = directory or cache_dir()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    compressed = config.get('cache_format', 'json') == 'zlib'
+
+    if config.get('cache_backend', 'file') == 'sqlite':
+        return SQLiteStore(os.path.join(directory, 'cache.db'), compressed)
+
+    return FileStore(directory, compressed)
+
+
+BACKEND = None
+BACKEND_LOCK = threading.Lock()
+
+
+def get_backend():
+    """
+    :returns: The cache shared by the whole process, created on the first call
+    :rtype: TwoTierCache
+    """
+
+    global BACKEND # pylint: disable=global-statement
+
+    with BACKEND_LOCK:
+        if BACKEND is None:
+            BACKEND = TwoTierCache(
+                make_store(),
+                int(serverconfig.config_dict().get('cache_memory', 256)) * 2**20)
+
+    return BACKEND
@@ -45,11 +45,19 @@ can be some separation for the number of errors in a workflow
 :author: Daniel Abercrombie <dabercro@mit.edu>
 """
 
+import os
+import json
+import pickle
+import sqlite3
+import hashlib
+import tempfile
+import itertools
 import threading
 
 import cherrypy
 import numpy
 import sklearn.cluster
+import sklearn.neighbors
 
 from . import globalerrors
 from . import serverconfig
@@ -58,73 +66,313 @@ from . import errorutils
 
 def get_workflow_vectors(workflows, session=None, allmap=None):
     """
-    Gets the errors for workflows in a list of numpy arrays
+    Gets the errors for workflows as a matrix of features.
+    All of the errors are read with a single query,
+    and the database is not locked while the matrix is filled.
 
     :param str workflows: the workflows that vectors are returned for
     :param cherrypy.Session session: Stores the information for a session
     :param dict allmap: a globalerrors.ErrorInfo allmap to override the
                         session's allmap
-    :return: a list of numpy arrays of errors for the workflow
-    :rtype: list of numpy.array
+    :return: a row of errors for each workflow.
+             The columns are the error codes, then the site names, of the allmap.
+    :rtype: numpy.array
     """
     curs = globalerrors.check_session(session, can_refresh=True)
     if not allmap:
-        allmap = globalerrors.check_session(session).get_allmap()
+        allmap = curs.get_allmap()
+
+    contents = curs.execute('SELECT stepname, errorcode, sitename, SUM(numbererrors) '
+                            'FROM workflows GROUP BY stepname, errorcode, sitename')
+
+    return make_vectors(contents, workflows, allmap)
+
+
+def make_vectors(contents, workflows, allmap):
+    """
+    Fills the matrix of features for :func:`get_workflow_vectors`.
+    Errors of workflows that are not in the list are skipped.
+
+    :param list contents: Tuples of ``(stepname, errorcode, sitename, numbererrors)``
+    :param list workflows: The workflows to make vectors for
+    :param dict allmap: Lists of the error codes and site names for the columns
+    :return: a row of errors for each workflow
+    :rtype: numpy.array
+    """
 
     columns = ['errorcode', 'sitename']
-    column_output = {}
 
-    for column in columns:
-        # Initialize with all zeros
-        settings = serverconfig.config_dict()['cluster'][column]
-        column_output[column] = [numpy.zeros(len(allmap[column])) for _ in workflows]
+    # Map everything to its position in the output
+    workflow_index = {workflow: index for index, workflow in enumerate(workflows)}
+    step_index = {}
+    for stepname in set(row[0] for row in contents):
+        step_index[stepname] = workflow_index.get(stepname.split('/')[1], -1)
+
+    column_index = {
+        column: {str(name): index for index, name in enumerate(allmap[column])}
+        for column in columns
+        }
+
+    rows = numpy.array([step_index[row[0]] for row in contents] or [-1], dtype=int)
+    numerrors = numpy.array([row[3] for row in contents] or [0], dtype=float)
+    keep = rows >= 0
 
-        cherrypy.log('Getting db_lock: 3')
-        curs.db_lock.acquire()
-        curs.curs.execute("SELECT SUM(numbererrors), {0}, stepname "
-                          "FROM workflows "
-                          "GROUP BY stepname, {0} "
-                          "ORDER BY {0} ASC, stepname ASC;".format(column))
+    column_output = []
 
-        numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-        wfname = stepname.split('/')[1] if stepname else ''
+    for icol, column in enumerate(columns):
+        settings = serverconfig.config_dict()['cluster'][column]
 
-        for icol, value in enumerate(allmap[column]):
-            for iwkf, workflow in enumerate(workflows):
-                while colval == value and workflow == wfname:
-                    column_output[column][iwkf][icol] += numerrors
-                    numerrors, colval, stepname = curs.curs.fetchone() or (0, '', '')
-                    if stepname:
-                        wfname = stepname.split('/')[1]
+        cols = numpy.array([column_index[column].get(str(row[icol + 1]), -1)
+                            for row in contents] or [-1], dtype=int)
+        valid = keep & (cols >= 0)
 
-        cherrypy.log('releasing db_lock: 3')
-        curs.db_lock.release()
+        output = numpy.zeros((len(workflows), len(allmap[column])))
+        numpy.add.at(output, (rows[valid], cols[valid]), numerrors[valid])
 
         # Preprocessing here
-        for output in column_output[column]:
-            length = numpy.linalg.norm(output) or 1.0
-            norm = (float(settings['distance'])/1.4142 +
-                    2.0 * float(settings['width']) *
-                    (length/(length + float(settings['midpoint'])) - 0.5))/length
+        length = numpy.linalg.norm(output, axis=1)
+        length[length == 0] = 1.0
+        norm = (float(settings['distance'])/1.4142 +
+                2.0 * float(settings['width']) *
+                (length/(length + float(settings['midpoint'])) - 0.5))/length
+
+        column_output.append(output * norm[:, numpy.newaxis])
+
+    return numpy.concatenate(column_output, axis=1)
+
+
+def model_path():
+    """
+    :returns: The location of the saved clusterer in the workspace
+    :rtype: str
+    """
+
+    return os.path.join(serverconfig.config_dict()['workspace'], 'clusterer.pkl')
+
+
+def model_version(history_path, errors_path=''):
+    """
+    Makes a key that changes when the clustering settings or the training data change.
+    The contents of the paths are only read if they are local files.
+    In ``minibatch`` mode, only the history is used for training, so errors_path is ignored.
+
+    :param str history_path: Path to the workflow historical data
+    :param str errors_path: The errors that are also included in the clustering
+    :returns: The version key for a clusterer fit to this data
+    :rtype: str
+    """
+
+    settings = serverconfig.config_dict()['cluster']
+    if settings.get('mode') == 'minibatch':
+        errors_path = ''
+
+    digest = hashlib.sha1()
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+
+    for path in [history_path, errors_path]:
+        digest.update(path.encode())
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as data:
+                for chunk in iter(lambda: data.read(1 << 20), b''):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_model():
+    """
+    :returns: The clusterer saved in the workspace by :func:`get_clusterer`,
+              whatever version it is, or None if there is no usable one
+    :rtype: dict
+    """
 
-            output *= float(norm)
+    if not os.path.exists(model_path()):
+        return None
 
-    return [numpy.concatenate([column_output[col][iwkf] for col in columns]) \
-                for iwkf, _ in enumerate(workflows)]
+    try:
+        with open(model_path(), 'rb') as model:
+            return pickle.load(model)
+    # Models saved by other versions of scikit-learn can fail in many ways
+    except Exception as err: # pylint: disable=broad-except
+        cherrypy.log('Could not read saved clusterer: %s' % err)
+        return None
+
+
+def save_model(clusterer):
+    """
+    Saves a clusterer to the workspace.
+    The file is replaced all at once, so a crash never leaves half a model.
+
+    :param dict clusterer: The output of :func:`get_clusterer`
+    """
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(model_path())))
+    with os.fdopen(handle, 'wb') as model:
+        pickle.dump(clusterer, model, protocol=2)
+
+    os.rename(temp_path, model_path())
+
+
+def load_clusterer(history_path, errors_path=''):
+    """
+    :param str history_path: Path to the workflow historical data
+    :param str errors_path: The errors that are also included in the clustering
+    :returns: The saved clusterer if it was fit to this data with the current settings,
+              otherwise None
+    :rtype: dict
+    """
+
+    clusterer = read_model()
+
+    if clusterer and clusterer.get('version') == model_version(history_path, errors_path):
+        return clusterer
+
+    return None
+
+
+def iter_history_vectors(conn, allmap, batch_size, after_row=0):
+    """
+    Reads the vectors of workflows from a history database a few at a time,
+    so that the whole history is never in memory.
+
+    :param sqlite3.Connection conn: The connection to the history database
+    :param dict allmap: Lists of the error codes and site names for the columns
+    :param int batch_size: The number of workflows in each matrix
+    :param int after_row: Only read workflows with rows that have a higher rowid than this.
+                          The rows that were there before are included for these workflows.
+    :returns: A generator of matrices, like :func:`get_workflow_vectors`
+    :rtype: generator
+    """
+
+    get_workflow = lambda row: row[0].split('/')[1]
+
+    curs = conn.cursor()
+
+    new_workflows = None
+    if after_row:
+        curs.execute('SELECT DISTINCT stepname FROM workflows WHERE rowid > ?', (after_row,))
+        new_workflows = set(get_workflow(row) for row in curs.fetchall())
+
+    # Steps of the same workflow are next to each other when sorted
+    curs.execute('SELECT stepname, errorcode, sitename, SUM(numbererrors) FROM workflows '
+                 'GROUP BY stepname, errorcode, sitename ORDER BY stepname')
+
+    workflows = []
+    contents = []
+
+    for workflow, rows in itertools.groupby(curs, get_workflow):
+        if new_workflows is not None and workflow not in new_workflows:
+            continue
+
+        if len(workflows) == batch_size:
+            yield make_vectors(contents, workflows, allmap)
+            workflows = []
+            contents = []
+
+        workflows.append(workflow)
+        contents.extend(rows)
+
+    if workflows:
+        yield make_vectors(contents, workflows, allmap)
+
+
+def update_minibatch(history_path, saved=None):
+    """
+    Fits a mini-batch k-means clusterer by streaming the history database.
+    If the saved clusterer was made with the same settings,
+    it is only updated with the workflows that have new rows in the history.
+    The clusterer remembers the error codes and sites it started with,
+    so errors at newer sites or with newer codes are not in its features.
+
+    :param str history_path: Path to the history database. This must be a local file.
+    :param dict saved: An older output of this function
+    :return: A dict like :func:`get_clusterer`, with the extra keys
+             'settings', 'last_row', and 'num_fit'
+    :rtype: dict
+    """
 
+    settings = serverconfig.config_dict()['cluster']
 
-def get_clusterer(history_path, errors_path=''):
-    """Use this function to get the clusterer of workflows
+    conn = sqlite3.connect(history_path)
+    try:
+        if saved and saved.get('settings') == settings:
+            clusterer = saved['clusterer']
+            allmap = saved['allmap']
+            last_row = saved['last_row']
+            num_fit = saved['num_fit']
+        else:
+            cherrypy.log('Starting new mini-batch clusterer')
+            clusterer = sklearn.cluster.MiniBatchKMeans(n_clusters=settings['n_clusters'],
+                                                        batch_size=settings['batch_size'])
+            allmap = {
+                column: sorted(value for value, in conn.execute(
+                    'SELECT DISTINCT {0} FROM workflows'.format(column)))
+                for column in ['errorcode', 'sitename']
+                }
+            last_row = 0
+            num_fit = 0
+
+        new_last_row = conn.execute('SELECT MAX(rowid) FROM workflows').fetchone()[0] or 0
+
+        # The first fit needs at least one workflow per cluster
+        waiting = numpy.zeros((0, len(allmap['errorcode']) + len(allmap['sitename'])))
+
+        for vectors in iter_history_vectors(conn, allmap, settings['batch_size'], last_row):
+            vectors = numpy.concatenate([waiting, vectors])
+            if num_fit or len(vectors) >= settings['n_clusters']:
+                clusterer.partial_fit(vectors)
+                num_fit += len(vectors)
+                waiting = waiting[:0]
+            else:
+                waiting = vectors
+
+    finally:
+        conn.close()
+
+    if not num_fit:
+        raise ValueError('Only %i workflows in the history to fit %i clusters' %
+                         (len(waiting), settings['n_clusters']))
+
+    cherrypy.log('Mini-batch clusterer has been fit to %i workflows' % num_fit)
+
+    return {'clusterer': clusterer, 'allmap': allmap,
+            'version': model_version(history_path),
+            'settings': settings, 'last_row': new_last_row, 'num_fit': num_fit}
+
+
+def get_clusterer(history_path, errors_path='', previous=None):
+    """Use this function to get the clusterer of workflows.
+    If the clusterer saved in the workspace was fit to the same data
+    with the same settings, that is returned without fitting again.
+    Otherwise the new clusterer is saved.
 
     :param str history_path: Path to the workflow historical data.
                              This can be a local file path or a URL.
     :param str errors_path: The errors for a given session to include
-                            in the clustering
+                            in the clustering. This is not used in ``minibatch`` mode.
+    :param dict previous: An older output of this function.
+                          If ``warm_start`` is set in the ``cluster`` configuration,
+                          the fit starts from its centroids.
+                          If not given, the saved clusterer is used.
     :return: A dict of a clusterer that is fitted to historical data
-             with its allmap. The keys are 'clusterer' and 'allmap'.
+             with its allmap. The keys are 'clusterer', 'allmap', and 'version'.
     :rtype: dict
     """
 
+    version = model_version(history_path, errors_path)
+    saved = read_model()
+
+    if saved and saved.get('version') == version:
+        cherrypy.log('Using saved clusterer')
+        return saved
+
+    if serverconfig.config_dict()['cluster'].get('mode') == 'minibatch':
+        output = update_minibatch(history_path, saved)
+        save_model(output)
+        return output
+
+    previous = previous or saved
+
     cherrypy.log('Initializing cluster session')
 
     # This will be the location of our training data
@@ -133,12 +381,15 @@ def get_clusterer(history_path, errors_path=''):
         }
 
     # If the path to additional errors is given, add that to the clustering data.
+    # They are added to a copy, so that the history and the version of this model do not change.
     if errors_path:
+        fake_session['info'].copy_to_memory()
         errorutils.add_to_database(globalerrors.check_session(fake_session), errors_path)
         globalerrors.check_session(fake_session).set_all_lists()
 
     # Get the data by getting table for each workflow
     workflows = globalerrors.check_session(fake_session).return_workflows()
+    allmap = fake_session['info'].get_allmap()
 
     # Fill the data
     cherrypy.log('Getting workflow vectors')
@@ -148,46 +399,125 @@ def get_clusterer(history_path, errors_path=''):
     cherrypy.log('Fitting workflows...')
 
     settings = serverconfig.config_dict()['cluster']
-    clusterer = sklearn.cluster.KMeans(n_clusters=settings['n_clusters'],
-                                       n_init=settings['n_init'],
-                                       n_jobs=-1)
 
-    clusterer.fit(numpy.array(data))
+    # The old centroids are only useful if they are in the same space
+    if settings.get('warm_start') and previous and previous['allmap'] == allmap and \
+            previous['clusterer'].cluster_centers_.shape[0] == settings['n_clusters']:
+        cherrypy.log('Starting from previous centroids')
+        clusterer = sklearn.cluster.KMeans(n_clusters=settings['n_clusters'],
+                                           init=previous['clusterer'].cluster_centers_,
+                                           n_init=1,
+                                           n_jobs=-1)
+    else:
+        clusterer = sklearn.cluster.KMeans(n_clusters=settings['n_clusters'],
+                                           n_init=settings['n_init'],
+                                           n_jobs=-1)
+
+    clusterer.fit(data)
 
     cherrypy.log('Done')
 
-    return {'clusterer': clusterer, 'allmap': fake_session['info'].get_allmap()}
+    output = {'clusterer': clusterer, 'allmap': allmap, 'version': version}
+    save_model(output)
+
+    return output
+
+
+class ClusterGroups(object):
+    """
+    The clusters of the workflows in one ErrorInfo.
+    This is never changed after it is made, so it can be read without any lock.
+    New assignments make a new object that replaces the old one.
+    """
+
+    def __init__(self, labels, version=None):
+        """
+        :param dict labels: Points each workflow to its cluster label
+        :param str version: The version of the clusterer that made the labels
+        """
+
+        self.labels = dict(labels)
+        self.version = version
+
+        members = {}
+        for workflow, label in self.labels.items():
+            members.setdefault(label, []).append(workflow)
+
+        # Inverted index of each label to the workflows in it
+        self.members = {label: tuple(sorted(workflows)) for label, workflows in members.items()}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, workflow):
+        return workflow in self.labels
+
+    def group(self, workflow):
+        """
+        :param str workflow: The workflow to get the group for
+        :returns: The other workflows in the same cluster
+        :rtype: list
+        """
+
+        label = self.labels.get(workflow)
+        if label is None:
+            return []
+
+        return [wkf for wkf in self.members[label] if wkf != workflow]
+
+    def without(self, workflows):
+        """
+        :param set workflows: Workflows to drop the labels of
+        :returns: A copy of these groups without the given workflows
+        :rtype: ClusterGroups
+        """
+
+        return ClusterGroups({workflow: label for workflow, label in self.labels.items()
+                              if workflow not in workflows}, self.version)
 
 
 def get_workflow_groups(clusterer, session=None):
-    """Groups workflows together based on a fitted clusterer
+    """Groups workflows together based on a fitted clusterer.
+    Only the workflows without a label from this clusterer are predicted,
+    and the new groups replace the ones stored in the ErrorInfo.
+    This should be called in the background, holding :py:data:`CLUSTER_LOCK`.
 
     :param dict clusterer: is a dictionary with the clusterer fit with
                            historic data and the allmap to generate it.
                            This matches the output of :func:`get_clusterer`.
     :param cherrypy.Session session: Stores the information for a session
-    :returns: A dictionary pointing workflows to a group
-    :rtype: dict
+    :returns: The groups of all of the current workflows
+    :rtype: ClusterGroups
     """
 
     errorinfo = globalerrors.check_session(session, can_refresh=True)
 
-    if errorinfo.clusters:
-        return errorinfo.clusters
+    version = clusterer.get('version')
+    groups = errorinfo.clusters
+    # Groups from another clusterer do not mean anything to this one
+    if groups is None or groups.version != version:
+        groups = ClusterGroups({}, version)
+
+    # Refreshing the errors only removes the workflows that changed
+    workflows = [workflow for workflow in errorinfo.return_workflows()
+                 if workflow not in groups]
 
-    cherrypy.log('Fitting existing workflows.')
+    if workflows:
+        cherrypy.log('Fitting %i existing workflows.' % len(workflows))
 
-    workflows = globalerrors.check_session(session).return_workflows()
-    vectors = get_workflow_vectors(workflows, session, clusterer['allmap'])
+        vectors = get_workflow_vectors(workflows, session, clusterer['allmap'])
 
-    predictions = clusterer['clusterer'].predict(numpy.array(vectors))
+        predictions = clusterer['clusterer'].predict(vectors)
 
-    cherrypy.log(str(predictions))
+        cherrypy.log(str(predictions))
 
-    for index, workflow in enumerate(workflows):
-        errorinfo.clusters[workflow] = predictions[index]
+        labels = dict(groups.labels)
+        labels.update(zip(workflows, predictions.tolist()))
+        groups = ClusterGroups(labels, version)
 
-    return errorinfo.clusters
+    errorinfo.clusters = groups
+
+    return groups
 
 
 def get_clustered_group(workflow, clusterer, session=None):
@@ -198,21 +528,104 @@ def get_clustered_group(workflow, clusterer, session=None):
                                              historic data.
     :param cherrypy.Session session: Stores the information for a session
     :returns: List of other workflows in the same group
-    :rtype: set
+    :rtype: list
     """
 
-    output = []
+    return get_workflow_groups(clusterer, session).group(workflow)
+
 
-    predictions = get_workflow_groups(clusterer, session)
+def get_cluster(workflow, session=None):
+    """Get the group for a given workflow from the clusters already found
+    in the background by :func:`get_workflow_groups`.
+    This does not wait for any lock.
 
-    group = predictions.get(workflow)
+    :param str workflow: The workflow to get the group for.
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: List of other workflows in the same group,
+              which is empty if the workflow has not been clustered yet
+    :rtype: list
+    """
 
-    if group is not None:
-        for wkf, cluster in predictions.items():
-            if cluster == group and wkf != workflow:
-                output.append(wkf)
+    groups = globalerrors.check_session(session).clusters
 
-    return output
+    return groups.group(workflow) if groups is not None else []
+
+
+def get_neighbors(session=None):
+    """
+    Finds the nearest workflows to every workflow in the errors, using the same
+    vectors as the clustering.
+    This is done once for each ErrorInfo, and kept until its errors change.
+    Each new shared ErrorInfo gets its neighbors from :py:func:`index_neighbors`
+    before it is shared, so pages never have to wait for this.
+    The number of neighbors is set by ``neighbors`` in the ``cluster`` configuration.
+
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: A dictionary pointing each workflow to a list of tuples
+              of other workflows and their distance, closest first
+    :rtype: dict
+    """
+
+    errorinfo = globalerrors.check_session(session)
+    neighbors = errorinfo.neighbors
+
+    if neighbors is not None:
+        return neighbors
+
+    workflows = errorinfo.return_workflows()
+    neighbors = {}
+
+    if workflows:
+        cherrypy.log('Finding neighbors of %i workflows' % len(workflows))
+
+        vectors = get_workflow_vectors(workflows, session)
+        number = min(serverconfig.config_dict()['cluster'].get('neighbors', 10) + 1,
+                     len(workflows))
+
+        index = sklearn.neighbors.NearestNeighbors(n_neighbors=number).fit(vectors)
+        distances, indices = index.kneighbors(vectors)
+
+        for iwkf, workflow in enumerate(workflows):
+            neighbors[workflow] = [
+                (workflows[other], distance) for other, distance in
+                zip(indices[iwkf].tolist(), distances[iwkf].tolist())
+                if other != iwkf
+                ][:number - 1]
+
+    errorinfo.neighbors = neighbors
+
+    return neighbors
+
+
+def index_neighbors(errorinfo):
+    """
+    Finds the neighbors of all of the workflows in a new ErrorInfo.
+    This is one of the :py:data:`globalerrors.BUILD_HOOKS`.
+
+    :param globalerrors.ErrorInfo errorinfo: The ErrorInfo that was just built
+    """
+
+    get_neighbors({'info': errorinfo})
+
+
+globalerrors.BUILD_HOOKS.append(index_neighbors)
+
+
+def get_similar_workflows(workflow, session=None):
+    """Get the workflows with errors closest to a given workflow,
+    from the neighbors already found by :py:func:`get_neighbors`.
+    This does not find them if they are missing.
+
+    :param str workflow: The workflow to get the neighbors for
+    :param cherrypy.Session session: Stores the information for a session
+    :returns: List of tuples of other workflows and their distance, closest first,
+              which is empty if the neighbors have not been found yet
+    :rtype: list
+    """
+
+    neighbors = globalerrors.check_session(session).neighbors
+
+    return neighbors.get(workflow, []) if neighbors is not None else []
 
 
 CLUSTER_LOCK = threading.Lock()
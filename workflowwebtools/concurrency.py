@@ -0,0 +1,114 @@
+"""
+Tools for letting many requests run at once,
+while work for the same key is only done once at a time.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+
+class _Call(object):
+    """One computation in flight, and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Shares one computation between every thread that asks for the same key
+    while it is running.
+    Different keys run in parallel.
+    Nothing is kept after the computation finishes,
+    so the next call for a key runs again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        :param key: A hashable key for the computation
+        :param func: The function to call if no other thread is running this key
+        :param args: Positional arguments for func
+        :param kwargs: Keyword arguments for func
+        :returns: The return value of func, from this thread or the one running it
+        :raises: The same exception as func, if it failed
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class KeyedLocks(object):
+    """
+    A lock for each key, made when it is needed.
+    A lock is dropped once no thread holds or waits for it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Values are lists of [lock, number of users]
+        self._locks = {}
+
+    @contextmanager
+    def hold(self, keys):
+        """
+        Holds the locks of all of the given keys.
+        They are taken in sorted order so that two threads cannot deadlock.
+
+        :param list keys: The keys to lock
+        """
+
+        keys = sorted(set(keys))
+
+        with self._lock:
+            entries = []
+            for key in keys:
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                entries.append(entry)
+
+        acquired = []
+        try:
+            for entry in entries:
+                entry[0].acquire()
+                acquired.append(entry)
+
+            yield
+
+        finally:
+            for entry in acquired:
+                entry[0].release()
+
+            with self._lock:
+                for key, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._locks[key]
@@ -0,0 +1,159 @@
+"""
+Holds the errors of an :py:class:`globalerrors.ErrorInfo` in NumPy arrays,
+so that the global views can be summed without going back to the database.
+"""
+
+
+import numpy
+
+
+class ErrorMatrix(object):
+    """
+    Sparse counts of errors, stored as one entry per step, site and error code.
+    Each axis is coded by the position of its names in an ErrorInfo allmap.
+    """
+
+    AXES = ('stepname', 'sitename', 'errorcode')
+    """The names of the axes, which match the columns of the workflows table"""
+
+    def __init__(self, contents, allmap):
+        """
+        :param list contents: Tuples of ``(stepname, sitename, errorcode,
+                              numbererrors, sitereadiness)`` for each entry
+        :param dict allmap: The names for each axis,
+                            like :py:meth:`globalerrors.ErrorInfo.get_allmap`
+        """
+
+        self.names = {axis: list(allmap[axis]) for axis in self.AXES}
+        # Web forms give strings, so the names are looked up by string
+        self.index = {axis: {str(name): index for index, name in enumerate(names)}
+                      for axis, names in self.names.items()}
+
+        self.coords = {
+            axis: numpy.array([self.index[axis][str(entry[column])] for entry in contents],
+                              dtype=int)
+            for column, axis in enumerate(self.AXES)
+            }
+
+        self.counts = numpy.array([entry[3] for entry in contents], dtype=int)
+        self.readiness = numpy.array([entry[4] for entry in contents], dtype=object)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def mask(self, readymatch=None, **match):
+        """
+        :param list readymatch: If given, only match entries at sites with these readiness statuses
+        :param match: Each keyword is an axis, and points to the only name to match in that axis
+        :returns: A mask of the entries that match everything
+        :rtype: numpy.array of bools
+        """
+
+        output = numpy.ones(len(self), dtype=bool)
+
+        for axis, name in match.items():
+            index = self.index[axis].get(str(name))
+            if index is None:
+                return numpy.zeros(len(self), dtype=bool)
+
+            output &= self.coords[axis] == index
+
+        if readymatch:
+            output &= numpy.isin(self.readiness, list(readymatch))
+
+        return output
+
+    def reduce(self, axes, mask=None):
+        """
+        Sums the errors of all entries that share the same names in the given axes.
+
+        :param list axes: The axes to keep
+        :param numpy.array mask: If given, only sum the entries in this mask
+        :returns: The indices of each group in each axis, sorted by the first axis,
+                  and the sum of errors for each group
+        :rtype: tuple of (list of numpy.array, numpy.array)
+        """
+
+        coords = [self.coords[axis] for axis in axes]
+        counts = self.counts
+
+        if mask is not None:
+            coords = [coord[mask] for coord in coords]
+            counts = counts[mask]
+
+        if not len(counts):
+            return [numpy.zeros(0, dtype=int) for _ in axes], numpy.zeros(0, dtype=int)
+
+        keys = numpy.ravel_multi_index(coords, [len(self.names[axis]) for axis in axes])
+        groups, inverse = numpy.unique(keys, return_inverse=True)
+        sums = numpy.bincount(inverse, weights=counts).astype(int)
+
+        return list(numpy.unravel_index(groups, [len(self.names[axis]) for axis in axes])), sums
+
+    def dense(self, rowaxis, colaxis, mask=None, rownames=None, colnames=None):
+        """
+        :param str rowaxis: The axis along the rows of the table
+        :param str colaxis: The axis along the columns of the table
+        :param numpy.array mask: If given, only fill the table from entries in this mask
+        :param list rownames: The names of the rows, if not all of the names in rowaxis.
+                              Entries with other names are left out.
+        :param list colnames: The names of the columns, if not all of the names in colaxis
+        :returns: The sum of errors for each row and column
+        :rtype: numpy.array
+        """
+
+        (rows, cols), sums = self.reduce([rowaxis, colaxis], mask)
+
+        shape = []
+        keep = numpy.ones(len(sums), dtype=bool)
+        coords = []
+
+        for axis, names, indices in [(rowaxis, rownames, rows), (colaxis, colnames, cols)]:
+            if names is None:
+                shape.append(len(self.names[axis]))
+                coords.append(indices)
+            else:
+                # Map the indices of this matrix to the positions in the given names
+                positions = {str(name): pos for pos, name in enumerate(names)}
+                mapping = numpy.array([positions.get(str(name), -1)
+                                       for name in self.names[axis]] or [-1], dtype=int)
+                shape.append(len(names))
+                coords.append(mapping[indices])
+                keep &= coords[-1] >= 0
+
+        output = numpy.zeros(shape, dtype=int)
+        output[coords[0][keep], coords[1][keep]] = sums[keep]
+
+        return output
+
+    def tables(self, axis, names, rowaxis, colaxis, readymatch=None):
+        """
+        Fills a dense table for each of the given names in one axis, all at once.
+
+        :param str axis: The axis to split the tables by
+        :param list names: The names in that axis to get tables for
+        :param str rowaxis: The axis along the rows of each table
+        :param str colaxis: The axis along the columns of each table
+        :param list readymatch: If given, only fill the tables from sites with these statuses
+        :returns: The sum of errors, indexed by the position in names, row, then column
+        :rtype: numpy.array
+        """
+
+        positions = numpy.full(len(self.names[axis]), -1, dtype=int)
+        for position, name in enumerate(names):
+            index = self.index[axis].get(str(name))
+            if index is not None:
+                positions[index] = position
+
+        layers = positions[self.coords[axis]]
+        keep = layers >= 0
+        if readymatch:
+            keep &= numpy.isin(self.readiness, list(readymatch))
+
+        output = numpy.zeros((len(names), len(self.names[rowaxis]), len(self.names[colaxis])),
+                             dtype=int)
+        numpy.add.at(output,
+                     (layers[keep], self.coords[rowaxis][keep], self.coords[colaxis][keep]),
+                     self.counts[keep])
+
+        return output
@@ -33,13 +33,19 @@ def errors_from_list(workflows):
     """
     indict = {}
 
-    for workflow in workflows:
-        base = workflowinfo.WorkflowInfo(workflow)
-        prep_id = base.get_prep_id()
-        for wkf in set(workflowinfo.PrepIDInfo(prep_id).get_workflows()):
-            indict.update(
-                workflowinfo.WorkflowInfo(wkf).get_errors(get_unreported=True)
-                )
+    bases = [workflowinfo.WorkflowInfo(workflow) for workflow in workflows]
+    workflowinfo.prefetch(bases, ['workflow_params'])
+
+    prep_ids = [workflowinfo.PrepIDInfo(prep_id) for prep_id in
+                set(base.get_prep_id() for base in bases)]
+    workflowinfo.prefetch(prep_ids, ['requests'])
+
+    infos = [workflowinfo.WorkflowInfo(wkf) for wkf in
+             set(wkf for prep_id in prep_ids for wkf in prep_id.get_workflows())]
+    workflowinfo.prefetch(infos, workflowinfo.ERROR_SOURCES)
+
+    for info in infos:
+        indict.update(info.get_errors(get_unreported=True))
 
     return indict
 
@@ -106,33 +112,48 @@ def get_list_info(status_list):
     """
 
     indict = {}
-    for workflow in status_list:
-        indict.update(
-            workflowinfo.WorkflowInfo(workflow).get_errors(get_unreported=True)
-            )
+    infos = [workflowinfo.WorkflowInfo(workflow) for workflow in status_list]
+    workflowinfo.prefetch(infos, workflowinfo.ERROR_SOURCES)
+
+    for info in infos:
+        indict.update(info.get_errors(get_unreported=True))
 
     return indict
 
 
-def add_to_database(curs, data_location): # pylint: disable=too-complex
-    """Add data from a file to a central database through the passed cursor
+def load_errors(data_location):
+    """Get the errors from a data location
 
-    :param sqlite3.Cursor curs: is the cursor to the database
-    :param data_location: If a string, this
-         is the location of the file
-         or url of data to add to the database.
-         This should be in JSON format, and if a local file does not exist,
-         a url will be assumed. If the url is invalid,
-         an empty database will be returned.
-         If a list, it's a list of status to get workflows from wmstats.
+    :param data_location: Either the location of a JSON file or url,
+                          or a list of workflows.
+                          See :py:func:`add_to_database` for details.
     :type data_location: str or list
+    :returns: Errors in the format::
+
+              {step: {errorcode: {site: number_errors}}}
+
+    :rtype: dict
     """
 
-    indict = get_list_info(data_location) \
+    return get_list_info(data_location) \
         if isinstance(data_location, list) else \
         (open_location(data_location) or {})
 
-    number_added = 0
+
+def error_rows(indict): # pylint: disable=too-complex
+    """Build the rows of the workflows table from a dictionary of errors.
+    The site readiness is only looked up once for each site.
+
+    :param dict indict: Errors in the format::
+
+                        {step: {errorcode: {site: number_errors}}}
+
+    :returns: Tuples matching the columns made by :py:func:`create_table`
+    :rtype: list of tuples
+    """
+
+    readiness = {}
+    rows = []
 
     for stepname, errorcodes in indict.items():
         if 'LogCollect' in stepname or 'Cleanup' in stepname:
@@ -149,15 +170,39 @@ def add_to_database(curs, data_location): # pylint: disable=too-complex
                 numbererrors = numbererrors or int(errorcode == '-1')
 
                 if numbererrors:
-                    full_key = '_'.join([stepname, sitename, errorcode])
-                    if not list(curs.execute(
-                            'SELECT EXISTS(SELECT 1 FROM workflows WHERE fullkey=? LIMIT 1)',
-                            (full_key,)))[0][0]:
-                        number_added += 1
-                        curs.execute('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
-                                     (full_key, stepname, errorcode,
-                                      sitename, numbererrors,
-                                      sitereadiness.site_readiness(sitename)))
+                    if sitename not in readiness:
+                        readiness[sitename] = sitereadiness.site_readiness(sitename)
+
+                    rows.append(('_'.join([stepname, sitename, errorcode]),
+                                 stepname, errorcode, sitename, numbererrors,
+                                 readiness[sitename]))
+
+    return rows
+
+
+def add_to_database(curs, data_location):
+    """Add data from a file to a central database through the passed cursor.
+    All of the rows are inserted in a single transaction,
+    and rows with a key that is already in the database are skipped.
+
+    :param sqlite3.Cursor curs: is the cursor to the database
+    :param data_location: If a string, this
+         is the location of the file
+         or url of data to add to the database.
+         This should be in JSON format, and if a local file does not exist,
+         a url will be assumed. If the url is invalid,
+         an empty database will be returned.
+         If a list, it's a list of status to get workflows from wmstats.
+    :type data_location: str or list
+    :returns: The number of rows added and the number of duplicate rows skipped
+    :rtype: int, int
+    """
+
+    rows = error_rows(load_errors(data_location))
+
+    number_added = curs.executemany('INSERT OR IGNORE INTO workflows VALUES (?,?,?,?,?,?)',
+                                    rows).rowcount
+    number_duplicate = len(rows) - number_added
 
     # This is to prevent the ErrorInfo objects from locking the database
     if 'conn' in dir(curs):
@@ -165,6 +210,10 @@ def add_to_database(curs, data_location): # pylint: disable=too-complex
 
     if number_added:
         cherrypy.log('Number of points added to the database: %i' % number_added)
+    if number_duplicate:
+        cherrypy.log('Number of duplicate points skipped: %i' % number_duplicate)
+
+    return number_added, number_duplicate
 
 
 def create_table(curs):
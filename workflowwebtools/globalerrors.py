@@ -13,6 +13,7 @@ import threading
 
 from collections import defaultdict
 
+import numpy
 import cherrypy
 
 from cmstoolbox import sitereadiness
@@ -20,14 +21,20 @@ from cmstoolbox import sitereadiness
 from . import workflowinfo
 from . import errorutils
 from . import serverconfig
+from .errormatrix import ErrorMatrix
 from .reasonsmanip import reasons_list
 
 class ErrorInfo(object):
-    """Holds the information for any errors for a session"""
+    """
+    Holds the information for the errors.
+    One of these is shared by all sessions, see :py:func:`check_session`.
+    """
 
-    def __init__(self, data_location=''):
+    def __init__(self, data_location='', previous=None):
         """Initialization with a setup.
         :param str data_location: Set the location of the data to read in the info
+        :param ErrorInfo previous: If given, start from a copy of this ErrorInfo
+                                   and only apply the changes since it was made
         """
 
         self.data_location = data_location
@@ -36,13 +43,20 @@ class ErrorInfo(object):
         self.timestamp = None
         self.conn = None
         self.curs = None
+        self.from_file = False
+        # Other workflows in the same prep IDs, set by load_rows()
+        self.acdcs = []
         self.db_lock = threading.Lock()
         # These are setup by set_all_lists(), which is called in setup()
+        # info holds the lists of all steps, errors, and sites.
+        # It must not refer back to self, or __del__ stops the ErrorInfo being collected.
         self.info = None
         self.allsteps = None
         self.readiness = None
         # This is created in clusterworkflows.get_workflow_groups()
-        self.clusters = {}
+        self.clusters = None
+        # This is created in clusterworkflows.get_neighbors()
+        self.neighbors = None
         # These are set in get_workflow()
         self.workflowinfos = {}
         # These are set in get_prepid()
@@ -51,8 +65,13 @@ class ErrorInfo(object):
         self._step_tables = None
         # Filled by get_step_list
         self._step_list = None
+        # Filled by get_matrix
+        self._matrix = None
 
-        self.setup()
+        if previous is None or previous.from_file:
+            self.setup()
+        else:
+            self.setup_from(previous)
 
     def __del__(self):
         """Delete anything left over."""
@@ -84,6 +103,25 @@ class ErrorInfo(object):
 
         return output
 
+    def executemany(self, query, seq_of_params):
+        """
+        Locks the internal database and makes the query for each set of parameters.
+
+        :param str query: The query, which can include '?'
+        :param list seq_of_params: The parameters to pass into each query
+        :returns: The cursor used, which holds the number of rows changed
+        :rtype: sqlite3.Cursor
+        """
+
+        self.db_lock.acquire()
+        curs = self.conn.cursor()
+        try:
+            curs.executemany(query, seq_of_params)
+        finally:
+            self.db_lock.release()
+
+        return curs
+
 
     def setup(self):
         """Create an SQL database from the all_errors.json generated by production"""
@@ -97,8 +135,10 @@ class ErrorInfo(object):
 
         # Store everything into an SQL database for fast retrival
 
-        if isinstance(data_location, str) and data_location.endswith('.db') \
-                and os.path.exists(data_location):
+        self.from_file = isinstance(data_location, str) and data_location.endswith('.db') \
+            and os.path.exists(data_location)
+
+        if self.from_file:
             self.conn = sqlite3.connect(data_location, check_same_thread=False)
             curs = self.conn.cursor()
             self.curs = curs
@@ -109,34 +149,216 @@ class ErrorInfo(object):
             self.curs = curs
 
             errorutils.create_table(self)
-            errorutils.add_to_database(self, data_location)
+            rows = self.load_rows()
+            self.executemany('INSERT OR IGNORE INTO workflows VALUES (?,?,?,?,?,?)', rows)
+            self.conn.commit()
+
+            cherrypy.log('Number of points added to the database: %i' % len(rows))
+
+        self.set_lists()
+        self.connection_log('opened')
+
+    def copy_to_memory(self):
+        """
+        If the database was opened from a file, replace it with a copy in memory,
+        so that adding rows does not change the file.
+        """
+
+        if not self.from_file:
+            return
+
+        memory = sqlite3.connect(':memory:', check_same_thread=False)
 
+        self.db_lock.acquire()
+        try:
+            memory.executescript('\n'.join(self.conn.iterdump()))
+            self.conn.close()
+            self.conn = memory
+            self.curs = memory.cursor()
+            self.from_file = False
+        finally:
+            self.db_lock.release()
+
+    def setup_from(self, previous):
+        """
+        Copy the database and lists of another ErrorInfo,
+        then refresh only what changed since it was made.
+        The other ErrorInfo is not modified, so pages still reading it are not disturbed.
+        The cached WorkflowInfo and PrepIDInfo objects are shared with it.
+
+        :param ErrorInfo previous: The ErrorInfo to start from
+        """
+
+        self.timestamp = previous.timestamp
+
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.curs = self.conn.cursor()
+
+        errorutils.create_table(self)
+        self.executemany('INSERT INTO workflows VALUES (?,?,?,?,?,?)',
+                         previous.execute('SELECT * FROM workflows'))
+        self.conn.commit()
+
+        self.acdcs = previous.acdcs
+        self.info = previous.info
+        self.allsteps = previous.allsteps
+        self.readiness = previous.readiness
+        self.workflowinfos = previous.workflowinfos
+        self.prepidinfos = previous.prepidinfos
+        # These are never changed in place, only replaced
+        self.clusters = previous.clusters
+        self.neighbors = previous.neighbors
+        self._step_tables = previous._step_tables
+        self._step_list = previous._step_list
+        self._matrix = previous._matrix
 
-        self.set_all_lists()
-        self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
+        self.connection_log('copied')
+
+        self._refresh()
+
+    def load_rows(self):
+        """
+        Get the rows for the workflows table from the data location.
+        If the data location is not set explicitly, this includes the errors of
+        all of the other workflows that share a prep ID with a workflow in the errors.
+        These workflows are stored in ``self.acdcs``.
+
+        :returns: The rows to fill the database with
+        :rtype: list of tuples
+        """
+
+        data_location = self.data_location or serverconfig.all_errors_path()
+        rows = errorutils.error_rows(errorutils.load_errors(data_location))
+
+        self.acdcs = []
 
         if not self.data_location:
-            current_workflows = self.return_workflows()
+            current_workflows = sorted(set(row[1].split('/')[1] for row in rows))
+
+            workflowinfo.prefetch_parameters(
+                [self.get_workflow(wf) for wf in current_workflows])
 
             prep_ids = {self.get_workflow(wf).get_prep_id() for wf in current_workflows}
+            workflowinfo.prefetch([self.get_prepid(prep_id) for prep_id in prep_ids],
+                                  ['requests'])
 
-            other_workflows = sum([self.get_prepid(prep_id).get_workflows() \
-                                       for prep_id in prep_ids], [])
+            self.acdcs = sum([self.get_prepid(prep_id).get_workflows() \
+                                  for prep_id in prep_ids], [])
 
-            errorutils.add_to_database(self, [new for new in other_workflows \
-                                                  if new not in current_workflows])
-            self.set_all_lists()
-            current_workflows = self.return_workflows()
+            keys = set(row[0] for row in rows)
+            rows.extend(row for row in errorutils.error_rows(errorutils.get_list_info(
+                [new for new in self.acdcs if new not in current_workflows]))
+                        if row[0] not in keys)
 
-            # If all ACDCs are to be shown, include the ones with zero errors like this
-            if serverconfig.config_dict().get('include_all_acdcs'):
-                self.allsteps.extend(['/%s/' % zero for zero in other_workflows \
-                                          if zero not in current_workflows])
-                self.allsteps.sort()
+        return rows
 
-            self.readiness = [sitereadiness.site_readiness(site) for site in self.info[3]]
+    def set_lists(self):
+        """
+        Sets all of the lists like :py:func:`set_all_lists`,
+        adds the ACDCs without errors if configured to,
+        and gets the site readiness.
+        """
 
-        self.connection_log('opened')
+        allsteps, allerrors, allsites = self._all_lists()
+
+        # If all ACDCs are to be shown, include the ones with zero errors like this
+        if self.acdcs and serverconfig.config_dict().get('include_all_acdcs'):
+            current_workflows = set(step.split('/')[1] for step in allsteps)
+            allsteps.extend(['/%s/' % zero for zero in self.acdcs \
+                                 if zero not in current_workflows])
+            allsteps.sort()
+
+        self.info = allsteps, allerrors, allsites
+        self.allsteps = allsteps
+        # The axes of the matrix may have changed
+        self._matrix = None
+
+        self.set_readiness()
+
+    def set_readiness(self):
+        """
+        Gets the site readiness of all of the sites in the errors
+        """
+
+        self.readiness = [sitereadiness.site_readiness(site) for site in self.info[2]]
+
+    def _refresh(self):
+        """
+        Update the copied database with a new snapshot of the errors.
+        Only the rows that changed are inserted, updated or deleted,
+        and only the step tables, step lists and clusters of affected steps are rebuilt.
+        The lists of steps, sites and errors are only rebuilt if rows or ACDCs
+        are added or removed.
+        This is only done before the ErrorInfo is shared.
+        If the database cannot be updated, the changes are rolled back
+        and the exception is raised again.
+        """
+
+        old_acdcs = self.acdcs
+
+        new = {row[0]: row for row in self.load_rows()}
+        old = {row[0]: row for row in self.execute('SELECT * FROM workflows')}
+
+        inserts = [row for key, row in new.items() if key not in old]
+        updates = [(row[4], row[5], key) for key, row in new.items()
+                   if key in old and tuple(old[key][4:]) != row[4:]]
+        deletes = [(key,) for key in old if key not in new]
+
+        self.db_lock.acquire()
+        try:
+            curs = self.conn.cursor()
+            curs.executemany('INSERT INTO workflows VALUES (?,?,?,?,?,?)', inserts)
+            curs.executemany('UPDATE workflows SET numbererrors=?, sitereadiness=? '
+                             'WHERE fullkey=?', updates)
+            curs.executemany('DELETE FROM workflows WHERE fullkey=?', deletes)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            cherrypy.log('Failed to refresh errors. Changes rolled back.')
+            raise
+        finally:
+            self.db_lock.release()
+
+        self.timestamp = time.time()
+
+        cherrypy.log('Refreshed errors with %i inserts, %i updates, %i deletes' %
+                     (len(inserts), len(updates), len(deletes)))
+
+        changed_steps = set(row[1] for row in inserts) | \
+            set(old[key][1] for key, in deletes)
+        affected_steps = changed_steps | set(new[key][1] for _, _, key in updates)
+
+        # Each of these is built on the side and then replaces the old one,
+        # so other threads never read something half built
+        if self._step_tables is not None and affected_steps:
+            self._get_step_tables(affected_steps)
+
+        if self._step_list is not None and changed_steps:
+            workflows = set(step.split('/')[1] for step in changed_steps)
+            step_list = defaultdict(list, ((workflow, steps) for workflow, steps
+                                           in self._step_list.items()
+                                           if workflow not in workflows))
+
+            for stepname in sorted(set(row[1] for row in new.values())):
+                workflow = stepname.split('/')[1]
+                if workflow in workflows:
+                    step_list[workflow].append(stepname)
+
+            self._step_list = step_list
+
+        if affected_steps:
+            self._matrix = None
+            # Any change can move the neighbors of every workflow
+            self.neighbors = None
+
+        if self.clusters is not None and affected_steps:
+            self.clusters = self.clusters.without(
+                set(step.split('/')[1] for step in affected_steps))
+
+        if changed_steps or set(self.acdcs) != set(old_acdcs):
+            self.set_lists()
+        else:
+            self.set_readiness()
 
     def set_all_lists(self):
         """
@@ -144,6 +366,19 @@ class ErrorInfo(object):
         This should be called if data is added to the ErrorInfo cursor manually.
         """
 
+        allsteps, allerrors, allsites = self._all_lists()
+
+        self.info = allsteps, allerrors, allsites
+
+        self.allsteps = allsteps
+        self._matrix = None
+
+    def _all_lists(self):
+        """
+        :returns: The sorted lists of all steps, errors, and sites in the database
+        :rtype: tuple of lists
+        """
+
         def get_all(column):
             """Get list of all unique entries in the database
 
@@ -175,20 +410,19 @@ class ErrorInfo(object):
         allerrors = get_all('errorcode')
         allerrors.sort(key=safe_int)
 
-        self.info = self, allsteps, allerrors, allsites
-
-        self.allsteps = allsteps
+        return allsteps, allerrors, allsites
 
     def teardown(self):
         """Close the database when cache expires"""
         self._step_tables = None
         self._step_list = None
+        self._matrix = None
 
         self.conn.close()
         self.connection_log('closed')
 
-        if self.clusters:
-            self.clusters = {}
+        self.clusters = None
+        self.neighbors = None
 
     def connection_log(self, action):
         """Logs actions on the sqlite3 connection
@@ -206,9 +440,9 @@ class ErrorInfo(object):
         """
 
         return {  # lists of elements to call for each possible row and column
-            'errorcode': self.info[2],
-            'stepname':  self.info[1],
-            'sitename':  self.info[3]
+            'errorcode': self.info[1],
+            'stepname':  self.info[0],
+            'sitename':  self.info[2]
             }
 
     def return_workflows(self):
@@ -262,33 +496,72 @@ class ErrorInfo(object):
         """
 
         if self._step_list is None:
-            self._step_list = defaultdict(list)
+            step_list = defaultdict(list)
             cherrypy.log('Getting db_lock: 2')
             self.db_lock.acquire()
             self.curs.execute('SELECT DISTINCT(stepname) FROM workflows ORDER BY stepname')
             for tup in self.curs.fetchall():
                 stepname = tup[0]
-                self._step_list[stepname.split('/')[1]].append(stepname)
+                step_list[stepname.split('/')[1]].append(stepname)
             cherrypy.log('Releasing db_lock: 2')
             self.db_lock.release()
+            self._step_list = step_list
 
-        return self._step_list[workflow]
+        return self._step_list.get(workflow, [])
 
-    def _get_step_tables(self):
-        """Sets the internal step tables for fast fetching"""
+    def _get_step_tables(self, steps=None):
+        """Sets the internal step tables for fast fetching
 
-        # The keys are stepname, then sitereadiness
-        self._step_tables = defaultdict(lambda: defaultdict(list))
+        :param set steps: If given, only rebuild the tables for these steps
+        """
 
-        for step, ready, errors, site, code in self.execute(
-                """
+        query = """
                 SELECT stepname, sitereadiness, numbererrors, sitename, errorcode FROM workflows
-                ORDER BY errorcode ASC, sitename ASC
-                """):
+                {0} ORDER BY errorcode ASC, sitename ASC
+                """
+
+        # The keys are stepname, then sitereadiness
+        step_tables = defaultdict(lambda: defaultdict(list))
+
+        if steps is None:
+            contents = self.execute(query.format(''))
+
+        else:
+            # Tables of the other steps are kept as they are
+            step_tables.update((step, table) for step, table in self._step_tables.items()
+                               if step not in steps)
+            contents = []
+            for step in steps:
+                contents.extend(self.execute(query.format('WHERE stepname=?'), (step,)))
+
+        for step, ready, errors, site, code in contents:
             # Append everything to 'all' to keep the order
-            self._step_tables[step]['all'].append((errors, site, code))
+            step_tables[step]['all'].append((errors, site, code))
             # Order is not as important when we are getting sparse for different readiness
-            self._step_tables[step][ready].append((errors, site, code))
+            step_tables[step][ready].append((errors, site, code))
+
+        self._step_tables = step_tables
+
+    def get_matrix(self):
+        """
+        Gets the errors as an :py:class:`errormatrix.ErrorMatrix`.
+        It is built the first time this is called and kept until the errors change.
+
+        :returns: The errors of every step, site and error code
+        :rtype: errormatrix.ErrorMatrix
+        """
+
+        matrix = self._matrix
+
+        if matrix is None:
+            cherrypy.log('Building error matrix')
+            matrix = ErrorMatrix(
+                self.execute('SELECT stepname, sitename, errorcode, numbererrors, '
+                             'sitereadiness FROM workflows'),
+                self.get_allmap())
+            self._matrix = matrix
+
+        return matrix
 
     def get_step_table(self, step, readymatch=None):
         """
@@ -308,63 +581,205 @@ class ErrorInfo(object):
             self._get_step_tables()
 
         keys = readymatch or ['all']
+        table = self._step_tables.get(step, {})
 
         output = []
         for key in keys:
-            output.extend(self._step_tables[step][key])
+            output.extend(table.get(key, []))
 
         return output
 
 
 GLOBAL_INFO = None
 GLOBAL_LOCK = threading.Lock()
+BUILD_LOCK = threading.Lock()
+
+BUILD_HOOKS = []
+"""
+Functions that are given each new shared ErrorInfo before anyone else can read it.
+Other modules add to this list to build what the pages read from an ErrorInfo,
+so that no page has to build it while it waits.
+"""
 
 
-def check_session(session, can_refresh=False):
-    """If session is None, fills it.
+def run_build_hooks(info):
+    """
+    Runs each of the :py:data:`BUILD_HOOKS` on an ErrorInfo.
+    A failed hook is logged, and does not stop the ErrorInfo from being used.
 
-    :param cherrypy.Session session: the current session
-    :param bool can_refresh: tells the function if it is safe to refresh
-                             and close the old database
-    :returns: ErrorInfo of the session
+    :param ErrorInfo info: The ErrorInfo that was just built
+    """
+
+    for hook in BUILD_HOOKS:
+        try:
+            hook(info)
+        except Exception as err: # pylint: disable=broad-except
+            cherrypy.log('Build hook %s failed: %s' % (hook.__name__, err))
+
+
+class EmptyErrorInfo(ErrorInfo):
+    """
+    An ErrorInfo without any errors.
+    Pages are given this while the first shared ErrorInfo is being built.
+    """
+
+    def __init__(self):
+        super(EmptyErrorInfo, self).__init__('empty')
+
+    def load_rows(self):
+        """
+        :returns: No rows
+        :rtype: list
+        """
+
+        self.acdcs = []
+        return []
+
+
+EMPTY_INFO = None
+
+
+def empty_info():
+    """
+    :returns: An ErrorInfo without any errors, which is shared by everyone that needs one
+    :rtype: EmptyErrorInfo
+    """
+
+    global EMPTY_INFO
+
+    GLOBAL_LOCK.acquire()
+    try:
+        if EMPTY_INFO is None:
+            EMPTY_INFO = EmptyErrorInfo()
+    finally:
+        GLOBAL_LOCK.release()
+
+    return EMPTY_INFO
+
+
+def _first_info():
+    """
+    Builds the first shared ErrorInfo, if it is not there yet.
+    It is only published, holding :py:data:`GLOBAL_LOCK`, after it is built.
+    :py:data:`BUILD_LOCK` must be held by the caller.
+
+    :returns: The ErrorInfo shared by all sessions
     :rtype: ErrorInfo
     """
 
-    if session:
+    global GLOBAL_INFO
+
+    if GLOBAL_INFO is None:
+        info = ErrorInfo()
+        run_build_hooks(info)
+
         cherrypy.log('Getting global lock: 1')
         GLOBAL_LOCK.acquire()
-        if session.get('lock') is None:
-            session['lock'] = threading.Lock()
+        GLOBAL_INFO = info
         cherrypy.log('Releasing global lock: 1')
         GLOBAL_LOCK.release()
 
-        cherrypy.log('Getting session lock')
-        session['lock'].acquire()
+    return GLOBAL_INFO
 
-        if session.get('info') is None:
-            session['info'] = ErrorInfo()
-        theinfo = session.get('info')
 
-    else:
-        cherrypy.log('Getting global lock: 2')
-        GLOBAL_LOCK.acquire()
-        global GLOBAL_INFO
+def shared_info(wait=True):
+    """
+    :param bool wait: If False and another thread is building the first ErrorInfo,
+                      return an empty ErrorInfo instead of waiting for it
+    :returns: The ErrorInfo shared by all sessions, which is created the first time it is needed
+    :rtype: ErrorInfo
+    """
+
+    info = GLOBAL_INFO
+    if info is not None:
+        return info
+
+    if not BUILD_LOCK.acquire(wait):
+        return empty_info()
+
+    try:
+        return _first_info()
+    finally:
+        BUILD_LOCK.release()
+
+
+def rebuild_info(wait=True):
+    """
+    Builds a new shared ErrorInfo from the current one, runs the :py:data:`BUILD_HOOKS`
+    on it, and then replaces the old one with it.
+    Sessions holding the old ErrorInfo can keep reading it until they are done.
+
+    :param bool wait: If False and another thread is already building,
+                      return right away instead of building again
+    :returns: The newest shared ErrorInfo, or an empty one if there is none yet
+    :rtype: ErrorInfo
+    """
+
+    global GLOBAL_INFO
+
+    if not BUILD_LOCK.acquire(wait):
+        cherrypy.log('Errors are already being rebuilt')
+        return GLOBAL_INFO or empty_info()
+
+    try:
+        # The first ErrorInfo has nothing to be rebuilt from
         if GLOBAL_INFO is None:
-            GLOBAL_INFO = ErrorInfo()
+            return _first_info()
 
-        theinfo = GLOBAL_INFO
+        old_info = GLOBAL_INFO
+        new_info = ErrorInfo(old_info.data_location, previous=old_info)
+        run_build_hooks(new_info)
+        cherrypy.log('Getting global lock: 2')
+        GLOBAL_LOCK.acquire()
+        GLOBAL_INFO = new_info
         cherrypy.log('Releasing global lock: 2')
         GLOBAL_LOCK.release()
+    finally:
+        BUILD_LOCK.release()
+
+    return new_info
+
+
+def rebuild_in_background():
+    """
+    Starts :py:func:`rebuild_info` in another thread, unless a rebuild is already running.
+    """
 
-    # If session ErrorInfo is old, set up another connection
+    if not BUILD_LOCK.locked():
+        builder = threading.Thread(target=rebuild_info, args=(False,))
+        builder.daemon = True
+        builder.start()
+
+
+def check_session(session, can_refresh=False):
+    """
+    Gets the ErrorInfo for a session.
+    Unless the session holds its own ErrorInfo under the key ``'info'``,
+    all sessions share the same one.
+    While another thread builds the first shared ErrorInfo, an empty one is given instead.
+    The session only stores the timestamp of the last ErrorInfo it was given.
+
+    :param cherrypy.Session session: the current session
+    :param bool can_refresh: tells the function if it is safe to start
+                             building a new ErrorInfo when the shared one is old.
+                             The old one is returned while the new one is built.
+    :returns: ErrorInfo of the session
+    :rtype: ErrorInfo
+    """
+
+    if session and session.get('info') is not None:
+        return session['info']
+
+    # Pages do not wait for the first ErrorInfo to be built
+    theinfo = shared_info(wait=False)
+
+    # If the shared ErrorInfo is old, replace it in the background
     if can_refresh and theinfo.timestamp < time.time() - \
             60*serverconfig.config_dict()['refresh_period']:
-        theinfo.teardown()
-        theinfo.setup()
+        rebuild_in_background()
 
-    if session:
-        cherrypy.log('Releasing session lock')
-        session['lock'].release()
+    if session is not None:
+        session['timestamp'] = theinfo.timestamp
 
     return theinfo
 
@@ -438,39 +853,21 @@ def get_step_table(step, session=None, allmap=None, readymatch=None,
     :rtype: list of lists or dict of dicts of ints
     """
     info = check_session(session)
-    if not allmap:
-        allmap = info.get_allmap()
-
-    contents = info.get_step_table(step, readymatch)
 
     if sparse:
         output = defaultdict(lambda: defaultdict(lambda: 0))
 
-        for numbererrors, sitename, errorcode in contents:
+        for numbererrors, sitename, errorcode in info.get_step_table(step, readymatch):
             output[str(errorcode)][sitename] = numbererrors
 
         return output
 
     # If not sparse
 
-    numbererrors, sitename, errorcode = contents.pop(0) if contents else (0, '', '')
-    steptable = []
-
-    for error in allmap['errorcode']:
-
-        steprow = []
-
-        for site in allmap['sitename']:
-
-            if error != errorcode or site != sitename:
-                steprow.append(0)
-            else:
-                steprow.append(numbererrors)
-                numbererrors, sitename, errorcode = contents.pop(0) if contents else (0, '', '')
+    matrix = info.get_matrix()
 
-        steptable.append(steprow)
-
-    return steptable
+    return matrix.dense('errorcode', 'sitename', matrix.mask(readymatch, stepname=step),
+                        allmap and allmap['errorcode'], allmap and allmap['sitename']).tolist()
 
 
 def see_workflow(workflow, session=None):
@@ -482,24 +879,27 @@ def see_workflow(workflow, session=None):
     :rtype: dict
     """
 
-    _, _, allerrors, allsites = check_session(session).info
-    steplist = check_session(session).get_step_list(workflow)
+    info = check_session(session)
+    _, allerrors, allsites = info.info
+    steplist = info.get_step_list(workflow)
+
+    # Indexed by step, error code, then site
+    steptables = info.get_matrix().tables('stepname', steplist, 'errorcode', 'sitename')
+    # The sites with no errors for each step
+    empty = ~steptables.any(axis=1)
 
     tables = []
-    # Each key is a step, and contains a list of sites to not put in the table
+    # Each key is a step, and contains the sites to not put in the table
     skip_site = {}
 
-    for step in steplist:
-        skip_site[step] = {'sites': [], 'index': []}
-        steptable = get_step_table(step, session)
-        tables.append(zip(steptable, allerrors))
-        for index, site in enumerate(allsites):
-            if sum([row[index] for row in steptable]) == 0:
-                skip_site[step]['index'].append(index)
-                skip_site[step]['sites'].append(site)
+    for step, steptable, emptysites in zip(steplist, steptables, empty):
+        indices = numpy.flatnonzero(emptysites).tolist()
+        skip_site[step] = {'sites': set(allsites[index] for index in indices),
+                           'index': set(indices)}
+        tables.append(list(zip(steptable.tolist(), allerrors)))
 
     return {
-        'steplist':  zip(steplist, tables),
+        'steplist':  list(zip(steplist, tables)),
         'allerrors': allerrors,
         'allsites':  allsites,
         'skips': skip_site,
@@ -546,19 +946,13 @@ def list_matching_pievars(pievar, row, col, session=None):
     :rtype: list
     """
 
-    curs = check_session(session, can_refresh=True)
+    matrix = check_session(session, can_refresh=True).get_matrix()
     rowname, colname = get_row_col_names(pievar)
 
-    output = []
+    (indices, ), sums = matrix.reduce([pievar], matrix.mask(**{rowname: row, colname: col}))
+    names = matrix.names[pievar]
 
-    # Let's do this very carefully and stupid for now...
-    for name, num in  curs.execute(('SELECT {0}, numbererrors FROM workflows '
-                                    'WHERE {1}=? AND {2}=?'.
-                                    format(pievar, rowname, colname)),
-                                   (row, col)):
-        output.append((name, num))
-
-    return output
+    return [(names[index], num) for index, num in zip(indices.tolist(), sums.tolist())]
 
 
 def get_errors(pievar, session=None):
@@ -580,16 +974,19 @@ def get_errors(pievar, session=None):
 
     rowname, colname = get_row_col_names(pievar)
 
-    query = 'SELECT numbererrors, {0}, {1}, {2} FROM workflows ' \
-        'ORDER BY {0} ASC, {1} ASC, {2} ASC;'.format(rowname, colname, pievar)
+    matrix = check_session(session, True).get_matrix()
+    (rows, cols, pvars), sums = matrix.reduce([rowname, colname, pievar])
 
-    curs = check_session(session, True)
-    contents = curs.execute(query)
+    rownames, colnames, pvarnames = [matrix.names[axis] for axis in (rowname, colname, pievar)]
+    totals = numpy.bincount(rows, weights=sums).astype(int).tolist()
 
     output = default_errors_format()
 
-    for numerrors, row, col, pvar in contents:
-        output[row]['errors'][col][pvar] = numerrors
-        output[row]['total'] += numerrors
+    # The groups come back sorted by row, column, then pievar
+    for row, col, pvar, numerrors in zip(rows.tolist(), cols.tolist(),
+                                         pvars.tolist(), sums.tolist()):
+        group = output[rownames[row]]
+        group['errors'][colnames[col]][pvarnames[pvar]] = numerrors
+        group['total'] = totals[row]
 
     return output
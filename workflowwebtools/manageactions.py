@@ -7,17 +7,40 @@
 
 from __future__ import print_function
 
+import os
 import time
 import datetime
 import ssl
+import threading
+
+from collections import OrderedDict
 
 import cherrypy
 import pymongo
 
 from . import serverconfig
 from . import reasonsmanip
+from . import workflowinfo
 from .globalerrors import check_session
 
+
+class FailedWrite(Exception):
+    """
+    An exception that is raised if the actions of some workflows could not be written.
+    The actions of the other workflows were still written.
+    """
+
+    def __init__(self, failures):
+        """
+        :param dict failures: The workflows that failed, pointing to their error messages
+        """
+
+        super(FailedWrite, self).__init__(
+            'Could not write the actions of %s' %
+            ', '.join('%s (%s)' % item for item in sorted(failures.items())))
+        self.failures = failures
+
+
 def extract_reasons_params(action, **kwargs):
     """Extracts the reasons and parameters for an action from kwargs
 
@@ -94,6 +117,7 @@ def submitaction(user, workflows, action, session=None, **kwargs):
     :param kwargs: can include various reasons and additional datasets
     :returns: a tuple of workflows, reasons, and params for the action
     :rtype: list, str, list of dicts, dict
+    :raises FailedWrite: if the action of any workflow could not be written
     """
 
     cherrypy.log('args: {0}'.format(kwargs))
@@ -105,27 +129,14 @@ def submitaction(user, workflows, action, session=None, **kwargs):
 
     cherrypy.log('Parameters: {0}'.format(params))
 
-    coll = get_actions_collection()
-
     error_info = check_session(session)
 
-    # Let's define some lambdas to use to filter our ACDCs (sanity checks)
-    # First a quick shorthand for workflow parameters
-    get_params = lambda wkf: error_info.get_workflow(wkf).get_workflow_parameters()
-
-    # We want request type to be resubmission in our ACDC
-    is_resub = lambda wkf: \
-        get_params(wkf)['RequestType'] == 'Resubmission'
-
-    # We want our ACDC to be submitted after the original request
-    is_new = lambda wkf, workflow: \
-        datetime.datetime(*(get_params(wkf)['RequestDate'])) > \
-        datetime.datetime(*(get_params(workflow)['RequestDate']))
-
-
     if not isinstance(workflows, list):
         workflows = [workflows]
 
+    acdcs = find_acdcs(workflows, error_info)
+    actions = []
+
     for workflow in workflows:
         wf_params = dict(params)
         step_list = error_info.get_step_list(workflow)
@@ -165,25 +176,34 @@ def submitaction(user, workflows, action, session=None, **kwargs):
             'Parameters': wf_params,
             'Reasons': [reason['long'] for reason in reasons],
             'user': user,
-            'ACDCs': [wkf for wkf in error_info.get_prepid(
-                error_info.get_workflow(workflow).get_prep_id()).get_workflows() \
-                          if wkf != workflow and is_resub(wkf) and is_new(wkf, workflow)]
+            'ACDCs': acdcs[workflow]
             }
 
         cherrypy.log('About to insert workflow: %s action: %s' % (workflow, document))
 
-        coll.update_one({'workflow': workflow},
-                        {'$set':
-                             {'timestamp': int(time.time()),
-                              'parameters': document,
-                              'acted': 0}},
-                        upsert=True)
+        actions.append((workflow, document))
+
+    results = write_actions(actions)
+    cherrypy.log('Submitted: %s' % results)
+
+    failures = {workflow: result for workflow, result in results.items()
+                if result not in ['inserted', 'updated']}
+    if failures:
+        raise FailedWrite(failures)
 
     return workflows, reasons, params
 
 
-def submit2(documents): # pylint: disable=missing-docstring
-    coll = get_actions_collection()
+def submit2(documents):
+    """Writes actions that were put together by the client
+
+    :param list documents: Dictionaries with the ``workflow``
+                           and the ``parameters`` of its action
+    :returns: The result of :py:func:`write_actions`
+    :rtype: dict
+    """
+
+    actions = []
 
     for document in documents:
         workflow = document['workflow']
@@ -191,12 +211,99 @@ def submit2(documents): # pylint: disable=missing-docstring
 
         cherrypy.log('About to insert workflow: %s action: %s' % (workflow, params))
 
-        coll.update_one({'workflow': workflow},
-                        {'$set':
-                             {'timestamp': int(time.time()),
-                              'parameters': params,
-                              'acted': 0}},
-                        upsert=True)
+        actions.append((workflow, params))
+
+    return write_actions(actions)
+
+
+def find_acdcs(workflows, error_info):
+    """Finds the ACDCs of many workflows at once.
+    These are the resubmissions in the same prep ID that were requested
+    after the original workflow.
+    The parameters of all of the workflows and prep IDs are fetched together first.
+
+    :param list workflows: The original workflows
+    :param globalerrors.ErrorInfo error_info: Holds the workflow and prep ID information
+    :returns: Each workflow pointing to a list of its ACDCs
+    :rtype: dict
+    """
+
+    workflowinfo.prefetch([error_info.get_workflow(wkf) for wkf in workflows],
+                          ['workflow_params'])
+
+    prep_ids = {workflow: error_info.get_workflow(workflow).get_prep_id()
+                for workflow in workflows}
+    # Getting the requests of a prep ID also caches the parameters of its workflows
+    workflowinfo.prefetch([error_info.get_prepid(prep_id) for prep_id in set(prep_ids.values())],
+                          ['requests'])
+
+    members = {prep_id: error_info.get_prepid(prep_id).get_workflows()
+               for prep_id in set(prep_ids.values())}
+
+    all_params = {}
+
+    def get_params(wkf):
+        """Each workflow's parameters are only looked up once"""
+        if wkf not in all_params:
+            all_params[wkf] = error_info.get_workflow(wkf).get_workflow_parameters()
+        return all_params[wkf]
+
+    # We want request type to be resubmission in our ACDC
+    is_resub = lambda wkf: \
+        get_params(wkf)['RequestType'] == 'Resubmission'
+
+    # We want our ACDC to be submitted after the original request
+    is_new = lambda wkf, workflow: \
+        datetime.datetime(*(get_params(wkf)['RequestDate'])) > \
+        datetime.datetime(*(get_params(workflow)['RequestDate']))
+
+    return {
+        workflow: [wkf for wkf in members[prep_ids[workflow]]
+                   if wkf != workflow and is_resub(wkf) and is_new(wkf, workflow)]
+        for workflow in workflows
+        }
+
+
+def write_actions(actions):
+    """Writes the actions for many workflows with a single unordered bulk write.
+    If a workflow is given more than once, its last action is used.
+
+    :param list actions: Tuples of each workflow and the parameters of its action
+    :returns: Each workflow pointing to ``'inserted'`` if it did not have an action before,
+              ``'updated'`` if it did, or the error message if the write failed
+    :rtype: dict
+    """
+
+    actions = list(OrderedDict(actions).items())
+    if not actions:
+        return {}
+
+    timestamp = int(time.time())
+    updated = time.time()
+    requests = [pymongo.UpdateOne({'workflow': workflow},
+                                  {'$set':
+                                       {'timestamp': timestamp,
+                                        'parameters': document,
+                                        'acted': 0,
+                                        'updated': updated}},
+                                  upsert=True)
+                for workflow, document in actions]
+
+    output = {workflow: 'updated' for workflow, _ in actions}
+
+    try:
+        upserted = get_actions_collection().bulk_write(requests, ordered=False).upserted_ids
+    except pymongo.errors.BulkWriteError as error:
+        upserted = {item['index']: item['_id'] for item in error.details.get('upserted', [])}
+        for item in error.details.get('writeErrors', []):
+            output[actions[item['index']][0]] = item['errmsg']
+
+    for index in upserted:
+        output[actions[index][0]] = 'inserted'
+
+    STATUSES.poll_if_loaded()
+
+    return output
 
 
 def get_actions(num_days=None, num_hours=24, acted=0):
@@ -222,7 +329,7 @@ def get_actions(num_days=None, num_hours=24, acted=0):
     if acted is None:
         query.pop('acted')
 
-    for match in coll.find(query):
+    for match in coll.find(query, {'_id': False, 'workflow': True, 'parameters': True}):
         output[match['workflow']] = match['parameters']
 
     return output
@@ -238,7 +345,7 @@ def get_datetime_submitted(workflow):
 
     coll = get_actions_collection()
 
-    info = coll.find_one({'workflow': workflow})
+    info = coll.find_one({'workflow': workflow}, {'_id': False, 'timestamp': True})
     if info:
         return datetime.datetime.fromtimestamp(info['timestamp'])
 
@@ -255,7 +362,126 @@ def get_acted_workflows(num_days):
     :rtype: list
     """
 
-    return list(get_actions(num_days, acted=None))
+    return STATUSES.acted_workflows(num_days)
+
+
+def changes_since(timestamp=0):
+    """Get the acted status of workflows whose actions changed after some time.
+    Every write through this module sets the time it changed an action under ``updated``.
+
+    :param float timestamp: Only return actions changed after this time.
+                            If 0, every action is returned.
+    :returns: Dictionaries with the ``workflow``, whether it was ``acted`` on,
+              the ``timestamp`` it was submitted, and when it was ``updated``, if known
+    :rtype: list
+    """
+
+    query = {'updated': {'$gt': timestamp}} if timestamp else {}
+
+    return list(get_actions_collection().find(
+        query, {'_id': False, 'workflow': True, 'acted': True,
+                'timestamp': True, 'updated': True}))
+
+
+class StatusCache(object):
+    """
+    Keeps whether each workflow has been acted on,
+    and when its action was submitted, in memory.
+    It is filled with one query the first time it is read.
+    After that, each :py:meth:`poll` only reads the actions changed since the last one,
+    so writes from other processes show up after the next poll.
+
+    The ``updated`` time of a change comes from the clock of its writer,
+    and is set before the write is committed.
+    So each poll reads back ``poll_overlap`` seconds, set under ``actions``
+    in the server configuration, before the newest change it has seen.
+    Changes read twice just set the same status again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Points workflows to tuples of (acted, timestamp). It is replaced, not changed.
+        self._records = None
+        self._since = 0
+
+    @property
+    def loaded(self):
+        """If the cache has been filled yet"""
+        return self._records is not None
+
+    def poll(self):
+        """
+        Reads the actions changed since the last poll, or all of them the first time
+        """
+
+        with self._lock:
+            start = time.time()
+            overlap = serverconfig.config_dict()['actions'].get('poll_overlap', 300)
+            changes = changes_since(max(self._since - overlap, 0) if self._since else 0)
+
+            records = dict(self._records or {})
+            for change in changes:
+                records[change['workflow']] = (change['acted'], change['timestamp'])
+
+            self._since = max([change.get('updated', 0) for change in changes] +
+                              [self._since or start])
+            self._records = records
+
+    def poll_if_loaded(self):
+        """
+        Reads new changes, if the cache is already in use.
+        This is called after every write to the actions in this process.
+        """
+
+        if self.loaded:
+            self.poll()
+
+    def clear(self):
+        """
+        Empties the cache, so that it is filled again the next time it is read
+        """
+
+        with self._lock:
+            self._records = None
+            self._since = 0
+
+    def records(self):
+        """
+        :returns: Workflows pointing to whether they were acted on and when they were submitted
+        :rtype: dict
+        """
+
+        if not self.loaded:
+            self.poll()
+
+        return self._records
+
+    def get(self, workflow):
+        """
+        :param str workflow: The workflow to check
+        :returns: The acted flag of the workflow, or ``None`` if it has no action
+        :rtype: int
+        """
+
+        record = self.records().get(workflow)
+        return None if record is None else record[0]
+
+    def acted_workflows(self, num_days):
+        """
+        :param int num_days: The number of past days to check for actions.
+                             If 0, all actions are checked.
+        :returns: The workflows with actions submitted in that time
+        :rtype: list
+        """
+
+        age_to_compare = int(time.time()) - num_days * 24 * 3600 if num_days > 0 else 0
+
+        return [workflow for workflow, (_, timestamp) in self.records().items()
+                if timestamp > age_to_compare]
+
+
+STATUSES = StatusCache()
+"""The action statuses shared by the whole process"""
 
 
 def report_actions(workflows, output=None):
@@ -268,7 +494,8 @@ def report_actions(workflows, output=None):
     coll = get_actions_collection()
 
     if output is not None:
-        records = list(coll.find({'workflow': {'$in': workflows}}))
+        records = list(coll.find({'workflow': {'$in': workflows}},
+                                 {'_id': False, 'workflow': True, 'acted': True}))
         output['success'] = [record['workflow'] for record in records
                              if record['acted'] == 0]
         output['already_reported'] = [record['workflow'] for record in records
@@ -279,28 +506,87 @@ def report_actions(workflows, output=None):
                                     wrkf not in record_names]
 
     coll.update_many({'workflow': {'$in': workflows}, 'acted': 0},
-                     {'$set': {'acted': 1}})
+                     {'$set': {'acted': 1, 'updated': time.time()}})
+
+    STATUSES.poll_if_loaded()
+
+
+CLIENT = None
+CLIENT_PID = None
+CLIENT_LOCK = threading.Lock()
+# Databases that the indexes have been made for by this process
+INDEXED = set()
+
+INDEXES = {
+    'workflow_unique': ([('workflow', pymongo.ASCENDING)], True),
+    'acted_timestamp': ([('acted', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], False),
+    'timestamp': ([('timestamp', pymongo.ASCENDING)], False),
+    'updated': ([('updated', pymongo.ASCENDING)], False)
+    }
+"""The indexes of the actions collection, by name, with their keys and uniqueness"""
+
+
+def get_client():
+    """Gets the MongoDB client shared by the whole process.
+    It keeps a pool of connections, with a size set by ``max_pool_size``
+    under ``actions`` in the server configuration.
+    The client does not connect until it is first used,
+    and a process that was forked makes its own client.
+
+    :returns: the MongoDB client
+    :rtype: pymongo.MongoClient
+    """
+
+    global CLIENT, CLIENT_PID # pylint: disable=global-statement
+
+    with CLIENT_LOCK:
+        if CLIENT is None or CLIENT_PID != os.getpid():
+            config_dict = serverconfig.config_dict()['actions']
+            options = {
+                'connect': False,
+                'maxPoolSize': config_dict.get('max_pool_size', 100)
+                }
+
+            uri = config_dict.get('uri')
+            if uri:
+                CLIENT = pymongo.MongoClient(uri, ssl_cert_reqs=ssl.CERT_NONE, **options)
+            else:
+                CLIENT = pymongo.MongoClient(**options)
+
+            CLIENT_PID = os.getpid()
+
+    return CLIENT
 
 
 def get_actions_collection():
     """Gets the actions collection from MongoDB.
+    The indexes in :py:data:`INDEXES` are checked the first time
+    each process asks for the collection.
 
     :returns: the actions collection
     :rtype: pymongo.collection.Collection
     """
 
-    config_dict = serverconfig.config_dict()['actions']
-    uri = config_dict.get('uri')
-    if uri:
-        client = pymongo.MongoClient(uri, ssl_cert_reqs=ssl.CERT_NONE)
-    else:
-        client = pymongo.MongoClient()
+    database = serverconfig.config_dict()['actions']['database']
+    coll = get_client()[database].actions
+
+    if database not in INDEXED:
+        with CLIENT_LOCK:
+            existing = coll.index_information()
+
+            # Replaced by the ascending index, which can be used to look up single workflows
+            if 'workflow' in existing:
+                try:
+                    coll.drop_index('workflow')
+                except pymongo.errors.OperationFailure as err:
+                    # Another process got here first
+                    cherrypy.log('Could not drop old workflow index: %s' % err)
 
-    coll = client[config_dict['database']].actions
+            for name, (keys, unique) in INDEXES.items():
+                if name not in existing:
+                    coll.create_index(keys, name=name, unique=unique)
 
-    if coll.count() == 0 or 'workflow' not in list(coll.index_information()):
-        coll.create_index([('workflow', pymongo.TEXT)],
-                          name='workflow', unique=True)
+            INDEXED.add(database)
 
     return coll
 
@@ -324,6 +610,6 @@ def fix_sites(**kwargs):
         output['Parameters'][subtask]['sites'] = value['sites']
 
         coll.update_one({'workflow': workflow},
-                        {'$set': {'parameters': output}})
+                        {'$set': {'parameters': output, 'updated': time.time()}})
 
     print(params)
@@ -5,6 +5,8 @@
 
 import os
 import sqlite3
+import threading
+
 import cherrypy
 
 from . import serverconfig
@@ -12,22 +14,116 @@ from . import serverconfig
 DEFAULT_SHORT = '---- No Short Reason Given, Not Saved to Database! ----'
 
 
-def get_reasons():
-    """Gets the reasons database in the local directory.
+class ReasonsStore(object):
+    """
+    Holds one connection to a reasons database, and the reasons in it.
+    The reasons are read again after :py:meth:`update`,
+    or when the file is changed by another process.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param str file_name: The location of the database
+        """
+
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.conn = None
+        # Identifies the file that conn is open on
+        self._inode = None
+        # Identifies the contents that _reasons were read from
+        self._version = None
+        self._reasons = None
+
+    def _stat(self):
+        """
+        :returns: The inode of the file, and the modification time and size,
+                  or ``None`` if there is no file
+        :rtype: tuple
+        """
+
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return None, None
+
+        return (stat.st_dev, stat.st_ino), (stat.st_mtime, stat.st_size)
+
+    def _check(self):
+        """
+        Opens the connection if this is the first call, or the file was replaced,
+        and forgets the reasons if the file was changed.
+        The lock must be held by the caller.
+        """
+
+        inode, version = self._stat()
+
+        if self.conn is None or inode != self._inode:
+            if self.conn is not None:
+                self.conn.close()
+
+            self.conn = sqlite3.connect(self.file_name, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS reasons '
+                              '(shortreason varchar(255) PRIMARY KEY, '
+                              'longreason varchar(4095))')
+            self.conn.commit()
+
+            inode, version = self._stat()
+            self._inode = inode
+            self._reasons = None
+
+        if version != self._version:
+            self._reasons = None
+
+    def reasons(self):
+        """
+        :returns: all of the reasons in a dictionary with the short reasons being the key
+        :rtype: dict
+        """
+
+        with self.lock:
+            self._check()
+
+            if self._reasons is None:
+                self._reasons = dict(
+                    self.conn.execute('SELECT shortreason, longreason FROM reasons'))
+                self._version = self._stat()[1]
+
+            return dict(self._reasons)
 
-    :returns: the reasons connection, cursor
-    :rtype: (sqlite3.Connection, sqlite3.Cursor)
+    def update(self, rows):
+        """
+        Adds reasons, keeping the long reason already stored for any short reason
+
+        :param list rows: Tuples of short and long reasons
+        """
+
+        with self.lock:
+            self._check()
+
+            self.conn.executemany('INSERT OR IGNORE INTO reasons VALUES (?,?)', rows)
+            self.conn.commit()
+            self._reasons = None
+
+
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+def get_store():
+    """Gets the store for the reasons database in the workspace.
+
+    :returns: the reasons store, which is shared by the whole process
+    :rtype: ReasonsStore
     """
 
-    conn = sqlite3.connect(os.path.join(serverconfig.config_dict()['workspace'], 'reasons.db'))
-    curs = conn.cursor()
-    curs.execute('SELECT name FROM sqlite_master WHERE type="table" and name="reasons"')
+    file_name = os.path.join(serverconfig.config_dict()['workspace'], 'reasons.db')
 
-    if not curs.fetchone():
-        curs.execute('CREATE TABLE reasons (shortreason varchar(255) PRIMARY KEY, '
-                     'longreason varchar(4095))')
+    with STORES_LOCK:
+        if file_name not in STORES:
+            STORES[file_name] = ReasonsStore(file_name)
 
-    return conn, curs
+        return STORES[file_name]
 
 
 def update_reasons(reasons):
@@ -40,24 +136,17 @@ def update_reasons(reasons):
     :raises KeyError: if the dictionaries in the list do not have the correct structure
     """
 
-    conn, curs = get_reasons()
-
     if not isinstance(reasons, list):
         raise TypeError('reasons is not a list')
 
     try:
-        for reason in reasons:
-            if reason['short'] == DEFAULT_SHORT:
-                continue
-            curs.execute('SELECT shortreason FROM reasons WHERE shortreason=?', (reason['short'],))
-            if not curs.fetchone():
-                curs.execute('INSERT INTO reasons VALUES (?,?)', (reason['short'], reason['long'],))
-        conn.commit()
+        rows = [(reason['short'], reason['long']) for reason in reasons
+                if reason['short'] != DEFAULT_SHORT]
     except KeyError:
         cherrypy.log('Parameter does not have correct keys.')
         raise
 
-    conn.close()
+    get_store().update(rows)
 
 
 def short_reasons_list():
@@ -67,16 +156,7 @@ def short_reasons_list():
     :rtype: list of strs
     """
 
-    conn, curs = get_reasons()
-
-    curs.execute('SELECT shortreason FROM reasons')
-    short_list = []
-    for item, in curs.fetchall():
-        short_list.append(item)
-
-    conn.close()
-
-    return short_list
+    return list(reasons_list())
 
 
 def reasons_list():
@@ -86,20 +166,4 @@ def reasons_list():
     :rtype: dict
     """
 
-    short_list = short_reasons_list()
-
-    conn, curs = get_reasons()
-
-    reasons = {}
-
-    for short in short_list:
-        curs.execute('SELECT longreason FROM reasons WHERE shortreason=?', (short,))
-        longreason = ''
-        for item in curs.fetchall():
-            longreason += (item[0])
-
-        reasons[short] = longreason
-
-    conn.close()
-
-    return reasons
+    return get_store().reasons()
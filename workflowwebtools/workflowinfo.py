@@ -8,28 +8,47 @@ Module containing and returning information about workflows.
 
 from __future__ import print_function
 
-import os
 import re
-import json
 import time
+import weakref
 import datetime
 import threading
 
 from collections import defaultdict
 from functools import wraps
 
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
 from cmstoolbox.webtools import get_json
 from cmstoolbox.sitereadiness import site_list
 
 from . import serverconfig
+from . import cachebackend
+from . import concurrency
+
+
+# Shared by every Info object, so that only one fetch of each value is in flight
+FETCHES = concurrency.SingleFlight()
+
+ERROR_SOURCES = ['jobdetail', 'acdc']
+"""The cached attributes that :py:meth:`WorkflowInfo.get_errors` is read from"""
+
 
 def cached_json(attribute, timeout=None):
     """
-    A decorator for caching dictionaries in local files.
+    A decorator for caching dictionaries through the shared
+    :py:mod:`cachebackend`.
+    While the value is missing, concurrent calls for the same workflow or prep ID
+    share one call of the decorated function, even from different objects.
 
     :param str attribute: The key of the :py:class:`WorkflowInfo` cache to
                           set using the decorated function.
-    :param int timeout: The amount of time before refreshing the JSON file, in seconds.
+    :param int timeout: The amount of time before refreshing the cached value, in seconds.
+                        If not given, the value of ``attribute`` under ``cache_refresh``
+                        in ``config.yml`` is used.
     :returns: Function decorator
     :rtype: func
     """
@@ -53,46 +72,155 @@ def cached_json(attribute, timeout=None):
             """
             tmout = timeout or serverconfig.config_dict()['cache_refresh'].get(attribute)
 
-            if not os.path.exists(self.cache_dir):
-                os.mkdir(self.cache_dir)
+            backend = cachebackend.get_backend()
+            key = self.cache_key(attribute)
+
+            def fetch():
+                """Check the cache again, and fill it if it is still empty"""
+                value = backend.get(key, tmout)
 
-            self.cachelock.acquire()
-            if attribute not in self.cachelocks:
-                self.cachelocks[attribute] = threading.Lock()
+                # If not cached, call the wrapped function
+                if value is None:
+                    value = func(self, *args, **kwargs)
+                    if value is not None:
+                        backend.set(key, value)
 
-            self.cachelocks[attribute].acquire()
-            self.cachelock.release()
+                return value
 
-            check_var = self.cache.get(attribute)
+            check_var = backend.get(key, tmout)
 
             if check_var is None:
-                file_name = self.cache_filename(attribute)
-                if os.path.exists(file_name) and \
-                        (tmout is None or time.time() - tmout < os.stat(file_name).st_mtime):
-                    try:
-                        with open(file_name, 'r') as cache_file:
-                            check_var = json.load(cache_file)
-                    except ValueError:
-                        print('JSON file no good. Deleting %s. Try again later.' % file_name)
-                        os.remove(file_name)
-
-                # If still None, call the wrapped function
-                if check_var is None:
-                    check_var = func(self, *args, **kwargs)
-                    with open(file_name, 'w') as cache_file:
-                        json.dump(check_var, cache_file)
-
-                self.cache[attribute] = check_var
-
-            self.cachelocks[attribute].release()
+                # Other objects for the same workflow or prep ID wait for this fetch
+                check_var = FETCHES.do((type(self).__name__, str(self), attribute), fetch)
 
             return check_var or {}
 
+        function_wrapper.cached_attribute = attribute
+
         return function_wrapper
 
     return cache_decorator
 
 
+# Filled by cached_attributes() the first time each class is seen
+CACHED_ATTRIBUTES = {}
+
+
+def cached_attributes(cls):
+    """
+    :param type cls: A subclass of :py:class:`Info`
+    :returns: The attributes cached by :py:func:`cached_json`
+              pointing to the names of the methods that fill them
+    :rtype: dict
+    """
+
+    if cls not in CACHED_ATTRIBUTES:
+        CACHED_ATTRIBUTES[cls] = {
+            getattr(getattr(cls, name), 'cached_attribute'): name
+            for name in dir(cls)
+            if hasattr(getattr(cls, name), 'cached_attribute')
+        }
+
+    return CACHED_ATTRIBUTES[cls]
+
+
+def prefetch(infos, attributes=None, threads=None):
+    """
+    Fill the cache of many :py:class:`Info` objects at once.
+    The remote calls are made concurrently by a bounded pool of threads,
+    so that whole lists of workflows can be loaded without waiting
+    for each request in turn.
+
+    :param list infos: The :py:class:`WorkflowInfo` or :py:class:`PrepIDInfo` objects
+    :param list attributes: The cached attributes to fill.
+                            If ``None``, every cached attribute of each object is filled.
+                            Attributes that an object does not have are skipped.
+    :param int threads: The maximum number of concurrent requests.
+                        The default is ``prefetch_threads`` in ``config.yml``.
+    """
+
+    tasks = Queue()
+
+    infos = list(infos)
+    if attributes is None or 'workflow_params' in attributes:
+        prefetch_parameters([info for info in infos if isinstance(info, WorkflowInfo)])
+
+    for info in infos:
+        methods = cached_attributes(type(info))
+        for attribute in (attributes or methods):
+            if attribute in methods:
+                tasks.put(getattr(info, methods[attribute]))
+
+    def worker():
+        """Calls the cached methods in the queue until it is empty"""
+        while True:
+            try:
+                method = tasks.get_nowait()
+            except Empty:
+                return
+
+            try:
+                method()
+            except Exception as error:
+                print('Failed to prefetch', method.__self__, method.__name__)
+                print(str(error))
+
+    if threads is None:
+        threads = serverconfig.config_dict().get('prefetch_threads', 16)
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(threads, tasks.qsize()))]
+
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    for thread in workers:
+        thread.join()
+
+
+def prefetch_parameters(infos, chunk_size=50):
+    """
+    Fill the ``workflow_params`` cache of many :py:class:`WorkflowInfo` objects
+    with one ReqMgr2 request for each chunk of workflow names.
+    Objects that already have their parameters cached are skipped.
+    This is called by :py:func:`prefetch`, so it does not need to be called separately.
+
+    :param list infos: The :py:class:`WorkflowInfo` objects to fill
+    :param int chunk_size: The maximum number of workflows to put in one request
+    """
+
+    timeout = serverconfig.config_dict()['cache_refresh'].get('workflow_params')
+    backend = cachebackend.get_backend()
+
+    missing = defaultdict(list)
+    for info in infos:
+        if backend.get(info.cache_key('workflow_params'), timeout) is None:
+            missing[info.url].append(info)
+
+    for url, url_infos in missing.items():
+        for start in range(0, len(url_infos), chunk_size):
+            chunk = url_infos[start:start + chunk_size]
+
+            try:
+                result = get_json(url,
+                                  '/reqmgr2/data/request',
+                                  params=[('name', info.workflow) for info in chunk],
+                                  use_https=True, use_cert=True)
+            except Exception as error:
+                print('Failed to get from reqmgr', len(chunk), 'workflows')
+                print(str(error))
+                continue
+
+            found = {}
+            for params in result.get('result', []):
+                found.update(params)
+
+            for info in chunk:
+                if found.get(info.workflow):
+                    info.set_cached('workflow_params', found[info.workflow])
+
+
 def list_workflows(status):
     """
     Get the list of workflows currently in a given status.
@@ -111,12 +239,28 @@ def list_workflows(status):
     return request['result']
 
 
-def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
+def jobdetail_steps(workflow, jobdetail):
     """
-    Get the useful status information from a workflow
+    Get the details for each step out of a jobdetail response
 
     :param str workflow: the name of the workflow request
-    :param str url: the base url to find the information at
+    :param dict jobdetail: the response of the wmstatsserver jobdetail API
+    :returns: the job details for each step, keyed by the step name
+    :rtype: dict
+    """
+
+    result = jobdetail.get('result')
+    if not result:
+        return {}
+
+    return result[0].get(workflow, {})
+
+
+def errors_from_steps(steps):
+    """
+    Get the useful status information from parsed job details
+
+    :param dict steps: the output of :py:func:`jobdetail_steps`
     :returns: a dictionary containing error codes in the following format::
 
               {step: {errorcode: {site: number_errors}}}
@@ -124,16 +268,9 @@ def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
     :rtype: dict
     """
 
-    result = get_json(url,
-                      '/wmstatsserver/data/jobdetail/%s' % workflow,
-                      use_cert=True)
-
     output = {}
 
-    if not result['result']:
-        return output
-
-    for step, stepdata in result['result'][0].get(workflow, {}).items():
+    for step, stepdata in steps.items():
         errors = {}
         for code, codedata in stepdata.get('jobfailed', {}).items():
             sites = {}
@@ -149,6 +286,23 @@ def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
 
     return output
 
+
+def errors_for_workflow(workflow, url='cmsweb.cern.ch'):
+    """
+    Get the useful status information from a workflow
+
+    :param str workflow: the name of the workflow request
+    :param str url: the base url to find the information at
+    :returns: a dictionary containing error codes in the following format::
+
+              {step: {errorcode: {site: number_errors}}}
+
+    :rtype: dict
+    """
+
+    return errors_from_steps(WorkflowInfo(workflow, url).get_jobdetail())
+
+
 def explain_errors(workflow, errorcode):
     """
     Get example errors for a given workflow and errorcode
@@ -159,16 +313,9 @@ def explain_errors(workflow, errorcode):
     :rtype: list
     """
 
-    result = get_json('cmsweb.cern.ch',
-                      '/wmstatsserver/data/jobdetail/%s' % workflow,
-                      use_cert=True)
-
     output = []
 
-    if not result['results']:
-        return output
-
-    for stepdata in result['result'][0].get(workflow, {}).values():
+    for stepdata in WorkflowInfo(workflow).get_jobdetail().values():
         for sitedata in stepdata.get('jobfailed', {}).get(errorcode, {}).values():
             for samples in sitedata['samples'][0]['errors'].values():
 
@@ -179,29 +326,52 @@ def explain_errors(workflow, errorcode):
 
 class Info(object):
     """
-    Implements shared operations on the cache
+    Implements shared operations on the cache.
+
+    There is only one object for each class, name and URL in use at a time.
+    Asking for it again gives back the same object, until nothing refers to it anymore.
     """
 
-    def __init__(self):
-        # Stores things using the cached_json decorator
-        self.cache = {}
-        self.cache_dir = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'workflowinfo')
-        self.bak_dir = os.path.join(self.cache_dir, 'bak')
-        self.cachelock = threading.Lock()
-        self.cachelocks = {}
+    __slots__ = ('__weakref__',)
+
+    _registry = weakref.WeakValueDictionary()
+    _registry_lock = threading.Lock()
+
+    def __new__(cls, name, url='cmsweb.cern.ch'):
+        key = (cls, name, url)
+
+        with Info._registry_lock:
+            obj = Info._registry.get(key)
+            if obj is None:
+                obj = super(Info, cls).__new__(cls)
+                # Set up while locked, so that no other thread sees it half done
+                obj.__init__(name, url)
+                Info._registry[key] = obj
+
+        return obj
 
     def __str__(self):
         pass
 
-    def cache_filename(self, attribute):
+    def cache_key(self, attribute):
         """
-        Return the name of the file for caching
+        Return the key that the cache backend stores an attribute under
 
-        :param str attribute: The information to store in the file
-        :returns: The full file name to store the cache
+        :param str attribute: The information to store
+        :returns: The key for this object and attribute
         :rtype: str
         """
-        return os.path.join(self.cache_dir, '%s_%s.cache.json' % (self, attribute))
+        return '%s_%s' % (self, attribute)
+
+    def set_cached(self, attribute, value):
+        """
+        Store a value for an attribute that was fetched by other means,
+        like a request for many objects at once.
+
+        :param str attribute: The attribute to set
+        :param value: The value that the cached method would have returned
+        """
+        cachebackend.get_backend().set(self.cache_key(attribute), value)
 
     def reset(self):
         """
@@ -209,15 +379,9 @@ class Info(object):
         """
         print('Reseting %s' % self)
 
-        if not os.path.exists(self.bak_dir):
-            os.mkdir(self.bak_dir)
-
-        for attribute in self.cache:
-            cache_file = self.cache_filename(attribute)
-            if os.path.exists(cache_file):
-                os.rename(cache_file, cache_file.replace(self.cache_dir, self.bak_dir))
-
-        self.cache.clear()
+        backend = cachebackend.get_backend()
+        for attribute in cached_attributes(type(self)):
+            backend.delete(self.cache_key(attribute))
 
 
 class WorkflowInfo(Info):
@@ -225,6 +389,8 @@ class WorkflowInfo(Info):
     Class that holds methods for accessing various information about a workflow.
     """
 
+    __slots__ = ('workflow', 'url', 'explanations', '_explained')
+
     def __init__(self, workflow, url='cmsweb.cern.ch'):
         """
         Initialize the workflow info class
@@ -233,12 +399,16 @@ class WorkflowInfo(Info):
         :param str url: is the url to fetch information from
         """
 
-        super(WorkflowInfo, self).__init__()
+        # Objects given back by the registry are already set up
+        if hasattr(self, 'url'):
+            return
+
         self.workflow = workflow
         self.url = url
 
-        # Is set first time get_explanation() is called
+        # Set when get_explanation() parses a newly stored jobdetail
         self.explanations = None
+        self._explained = None
 
     def __str__(self):
         return 'workflowinfo_%s' % self.workflow
@@ -272,11 +442,26 @@ class WorkflowInfo(Info):
         return None
 
 
-    @cached_json('errors')
+    @cached_json('acdc')
+    def _get_acdc(self):
+        """
+        Get the ACDC documents of this workflow from the ACDC server
+
+        :returns: The response of the ACDC server or cache
+        :rtype: dict
+        """
+
+        return get_json('cmsweb.cern.ch', '/couchdb/acdcserver/_design/ACDC/_view/byCollectionName',
+                        {'key': '"%s"' % self.workflow, 'include_docs': 'true', 'reduce': 'false'},
+                        use_cert=True)
+
     def get_errors(self, get_unreported=False):
         """
         A wrapper for :py:func:`errors_for_workflow` if you happen to have
         a :py:class:`WorkflowInfo` object already.
+        The errors are not cached themselves, but read from the cached jobdetail every time,
+        so that they always match :py:meth:`get_explanation`.
+        The attributes in :py:data:`ERROR_SOURCES` can be prefetched instead.
 
         :param bool get_unreported: Get the unreported errors from ACDC server
         :returns: a dictionary containing error codes in the following format::
@@ -286,15 +471,10 @@ class WorkflowInfo(Info):
         :rtype: dict
         """
 
-        output = errors_for_workflow(self.workflow, self.url)
+        output = errors_from_steps(self.get_jobdetail())
 
         if get_unreported:
-            acdc_server_response = get_json(
-                'cmsweb.cern.ch', '/couchdb/acdcserver/_design/ACDC/_view/byCollectionName',
-                {'key': '"%s"' % self.workflow, 'include_docs': 'true', 'reduce': 'false'},
-                use_cert=True)
-
-            for row in acdc_server_response['rows']:
+            for row in self._get_acdc().get('rows', []):
                 task = row['doc']['fileset_name']
 
                 new_output = output.get(task, {})
@@ -465,6 +645,63 @@ class WorkflowInfo(Info):
                         '/wmstatsserver/data/jobdetail/%s' % self.workflow,
                         use_cert=True)
 
+    def get_jobdetail(self):
+        """
+        Get the job details of each step.
+        Everything that reads the jobdetail should use this,
+        so that the document is only fetched once per refresh.
+
+        :returns: The output of :py:func:`jobdetail_steps` for this workflow
+        :rtype: dict
+        """
+
+        return jobdetail_steps(self.workflow, self._get_jobdetail())
+
+    def _get_explanations(self):
+        """
+        Parses the jobdetail into error logs, if it has been stored since the last parse.
+        The map is built completely before it is shared,
+        since other threads can be reading the same interned object.
+
+        :returns: error logs, keyed by error code and then by step name
+        :rtype: dict
+        """
+
+        backend = cachebackend.get_backend()
+        key = self.cache_key('jobdetail')
+        timeout = serverconfig.config_dict()['cache_refresh'].get('jobdetail')
+
+        # Only parse again if the jobdetail has been stored since the last time
+        timestamp = backend.timestamp(key, timeout)
+        if timestamp is not None and timestamp == self._explained:
+            return self.explanations
+
+        jobdetail = self._get_jobdetail()
+        timestamp = backend.timestamp(key, timeout)
+        explanations = defaultdict(lambda: defaultdict(lambda: []))
+        for stepname, stepdata in jobdetail_steps(self.workflow, jobdetail).items():
+            # Get the errors from both 'jobfailed' and 'submitfailed' details
+            for error, site in [(error, site) for status in ['jobfailed', 'submitfailed'] \
+                                    for error, site in stepdata.get(status, {}).items()]:
+                if error == '0':
+                    continue
+
+                for sitename, samples in site.items():
+                    for detail in [values for sample in samples['samples']
+                                   for errs in sample['errors'].values()
+                                   for values in errs]:
+
+                        explanations[error][stepname].append('\n\n'.join(
+                            ['Site name: %s' % sitename,
+                             '%s (Exit code: %s)' % (detail['type'], detail['exitCode']),
+                             detail['details']]))
+
+        # Publish the map before the timestamp that says it is current
+        self.explanations = explanations
+        self._explained = timestamp
+
+        return explanations
+
     def get_explanation(self, errorcode, step=''):
         """
         Gets a list of error logs for a given error code.
@@ -475,27 +712,7 @@ class WorkflowInfo(Info):
         :rtype: list
         """
 
-        if self.explanations is None:
-            self.explanations = defaultdict(lambda: defaultdict(lambda: []))
-            result = self._get_jobdetail()
-            for stepname, stepdata in result['result'][0].get(self.workflow, {}).items():
-                # Get the errors from both 'jobfailed' and 'submitfailed' details
-                for error, site in [(error, site) for status in ['jobfailed', 'submitfailed'] \
-                                        for error, site in stepdata.get(status, {}).items()]:
-                    if error == '0':
-                        continue
-
-                    for sitename, samples in site.items():
-                        for detail in [values for sample in samples['samples']
-                                       for errs in sample['errors'].values()
-                                       for values in errs]:
-
-                            self.explanations[error][stepname].append('\n\n'.join(
-                                ['Site name: %s' % sitename,
-                                 '%s (Exit code: %s)' % (detail['type'], detail['exitCode']),
-                                 detail['details']]))
-
-        explain = self.explanations.get(errorcode, {'': ['No info for this error code']})
+        explain = self._get_explanations().get(errorcode, {'': ['No info for this error code']})
 
         if step in explain.keys():
             return explain[step]
@@ -515,15 +732,12 @@ class WorkflowInfo(Info):
         :returns: the information to send to CMSMONIT
         :rtype: dict
         """
-        # Dummy call to get self.explanations filled
-        self.get_explanation(0)
-
         return {
             'errors': self.get_errors(True),
             'prepID': self.get_prep_id(),
             'params': self.get_workflow_parameters(),
             'recovery': self.get_recovery_info(),
-            'logs': self.explanations
+            'logs': self._get_explanations()
             }
 
 
@@ -532,8 +746,13 @@ class PrepIDInfo(Info):
     A class that just holds a small amount of information about a given PrepID.
     """
 
+    __slots__ = ('prep_id', 'url')
+
     def __init__(self, prep_id, url='cmsweb.cern.ch'):
-        super(PrepIDInfo, self).__init__()
+        # Objects given back by the registry are already set up
+        if hasattr(self, 'url'):
+            return
+
         self.prep_id = prep_id
         self.url = url
 
@@ -556,7 +775,12 @@ class PrepIDInfo(Info):
         if not result['result']:
             return None
 
-        return result['result'][0]
+        # The detailed requests are the same as the workflow parameters
+        requests = result['result'][0]
+        for workflow, params in requests.items():
+            WorkflowInfo(workflow, self.url).set_cached('workflow_params', params)
+
+        return requests
 
     def get_workflows_requesttime(self):
         """
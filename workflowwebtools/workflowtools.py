@@ -18,6 +18,7 @@ import sqlite3
 
 import cherrypy
 
+from cherrypy.process import plugins
 from cmstoolbox import sitereadiness
 
 from workflowwebtools import workflowinfo
@@ -30,6 +31,7 @@ from workflowwebtools import globalerrors
 from workflowwebtools import clusterworkflows
 from workflowwebtools import classifyerrors
 from workflowwebtools import actionshistorylink
+from workflowwebtools import concurrency
 from workflowwebtools.web.templates import render
 from workflowwebtools.predict import evaluate
 
@@ -43,13 +45,66 @@ class WorkflowTools(object):
     def __init__(self):
         self.lock = threading.Lock()
         self.wflock = threading.Lock()
-        self.readinesslock = threading.Lock()
-        self.seeworkflowlock = threading.Lock()
+        self.updatelock = threading.Lock()
+        # Requests for the same page share one computation
+        self.pages = concurrency.SingleFlight()
+        # Actions on the same workflow are submitted one at a time
+        self.submitlocks = concurrency.KeyedLocks()
+        data = serverconfig.config_dict()['data']
+        # A saved clusterer that is still current saves fitting again
+        self.clusterer = clusterworkflows.load_clusterer(
+            data['workflow_history'], data['all_errors'])
+        self.markedreset = set()
+
+        # These are filled in the background by warm_up()
+        self.workflows = {}
+        self.prepids = {}
+        self.site_statuses = []
+
+        self.schedule()
+
+    def schedule(self):
+        """
+        Subscribes background tasks to the CherryPy engine that refresh
+        the statuses, actions, errors, site readiness and clusters,
+        so that pages do not have to wait for remote data.
+        The number of seconds between each refresh is set under
+        ``background_refresh`` in the server configuration.
+        Everything is filled once right away in another thread by :py:meth:`warm_up`.
+        """
+
+        intervals = serverconfig.config_dict().get('background_refresh', {})
+        tasks = {
+            'statuses': self.update,
+            'actions': self.update_statuses,
+            'errors': self.update_errors,
+            'readiness': self.update_site_statuses,
+            'clusters': self.cluster
+        }
+
+        for name, task in tasks.items():
+            if intervals.get(name):
+                plugins.Monitor(cherrypy.engine, task, intervals[name],
+                                name='Refresh %s' % name).subscribe()
+
+        warm_up = threading.Thread(target=self.warm_up)
+        warm_up.daemon = True
+        warm_up.start()
+
+    def warm_up(self):
+        """
+        Builds the shared errors with their clusters and neighbors,
+        then fetches the site statuses and the workflows to show,
+        when the server starts, instead of waiting for the first scheduled refresh.
+        Pages show empty lists until each of these is done.
+        """
+
+        # Pages get an empty ErrorInfo until this is done
+        globalerrors.shared_info()
         self.cluster()
+        self.update_site_statuses()
         self.update()
 
-        self.markedreset = set()
-
 
     @cherrypy.expose
     def markreset(self, prepid):
@@ -80,33 +135,86 @@ class WorkflowTools(object):
 
 
     def update(self):
+        """
+        Gets the workflows and prep IDs to show, and fills their caches.
+        They replace the old ones only after everything is fetched.
+        If another thread is already updating, this returns right away.
+        """
 
-        self.lock.acquire()
-        self.workflows = {}
+        if not self.updatelock.acquire(False):
+            cherrypy.log('Workflows are already being updated')
+            return
 
         try:
-            for workflow in statuses.get_manual_workflows(
-                    serverconfig.config_dict()['data']['all_errors']):
-                self.get(workflow)
+            workflows = {
+                workflow: workflowinfo.WorkflowInfo(workflow) for workflow in
+                statuses.get_manual_workflows(serverconfig.config_dict()['data']['all_errors'])
+            }
+
+            workflowinfo.prefetch(workflows.values(), ['workflow_params'])
 
-            self.prepids = {
+            prepids = {
                 prepid: workflowinfo.PrepIDInfo(prepid) for prepid in
-                [info.get_prep_id() for info in self.workflows.values()]
+                [info.get_prep_id() for info in workflows.values()]
             }
 
+            # Fill everything that the prep ID pages need
+            workflowinfo.prefetch(prepids.values(), ['requests'])
+
+            acdcs = [workflow for prep_id in prepids.values()
+                     for workflow in prep_id.get_workflows()]
+            for workflow in acdcs:
+                if workflow not in workflows:
+                    workflows[workflow] = workflowinfo.WorkflowInfo(workflow)
+
+            workflowinfo.prefetch([workflows[workflow] for workflow in acdcs],
+                                  workflowinfo.ERROR_SOURCES)
+
             self.update_statuses()
 
-        finally:
+            self.lock.acquire()
+            self.workflows = workflows
+            self.prepids = prepids
             self.lock.release()
 
+        finally:
+            self.updatelock.release()
+
 
     def update_statuses(self):
-        coll = manageactions.get_actions_collection()
-        self.site_statuses = None
-        self.statuses = {
-            record['workflow']: record['acted']
-            for record in coll.find()
+        """
+        Reads the actions that changed since the last check into
+        :py:data:`manageactions.STATUSES`, which every status lookup reads from.
+        """
+
+        manageactions.STATUSES.poll()
+
+    def update_site_statuses(self):
+        self.site_statuses = [
+            {
+                'site': site,
+                'status': status,
+                'drain': drain
             }
+            for site, status, drain in sitereadiness.i_site_readiness()
+        ]
+
+    def update_errors(self):
+        """
+        Builds a new shared ErrorInfo and finds the clusters and neighbors of its workflows
+        """
+
+        globalerrors.rebuild_info(wait=False)
+
+        if self.clusterer is not None:
+            clusterworkflows.CLUSTER_LOCK.acquire()
+            try:
+                clusterworkflows.get_workflow_groups(self.clusterer)
+            finally:
+                clusterworkflows.CLUSTER_LOCK.release()
+
+        cherrypy.log('Errors updated for %i workflows' %
+                     len(globalerrors.check_session(None).return_workflows()))
 
     @cherrypy.expose
     def index(self):
@@ -126,20 +234,35 @@ class WorkflowTools(object):
         This is useful when the history database of past errors has been
         updated with relevant errors since the server has been started or
         this function has been called.
+        If the history and the clustering settings have not changed,
+        the clusterer saved in the workspace is kept.
+        Either way, any current workflows without a cluster are then grouped.
 
         :returns: a confirmation page
         :rtype: str
         """
         data = serverconfig.config_dict()['data']
-        self.clusterer = clusterworkflows.get_clusterer(
-            data['workflow_history'], data['all_errors'])
+        clusterer = clusterworkflows.get_clusterer(
+            data['workflow_history'], data['all_errors'], self.clusterer)
+
+        # Groups from an old clusterer are replaced, since their version does not match
+        clusterworkflows.CLUSTER_LOCK.acquire()
+        try:
+            self.clusterer = clusterer
+            clusterworkflows.get_workflow_groups(self.clusterer)
+        finally:
+            clusterworkflows.CLUSTER_LOCK.release()
+
         return render('complete.html')
 
     @cherrypy.expose
     def globalerror2(self, reset=False):
         if reset:
             self.reset()
-            self.update()
+            # The old prep IDs are shown until the update is done
+            updater = threading.Thread(target=self.update)
+            updater.daemon = True
+            updater.start()
 
         return render(
             'globalerror2.html'
@@ -157,7 +280,7 @@ class WorkflowTools(object):
         return evaluate.predict(self.get(workflow))
 
     def get_status(self, workflow):
-        status = self.statuses.get(workflow)
+        status = manageactions.STATUSES.get(workflow)
         if status is None:
             return "none"
         return "acted" if status else "pending"
@@ -215,9 +338,9 @@ class WorkflowTools(object):
     @cherrypy.tools.json_out()
     def submit2(self):
         input_json = cherrypy.request.json
-        manageactions.submit2(input_json['documents'])
+        results = manageactions.submit2(input_json['documents'])
         self.update_statuses()
-        return {'message': 'Done'}
+        return {'message': 'Done', 'results': results}
 
 
     @cherrypy.expose
@@ -411,42 +534,40 @@ class WorkflowTools(object):
                  Resets personal cache in the meanwhile, just in case
         """
 
-        self.seeworkflowlock.acquire()
+        info = globalerrors.check_session(cherrypy.session, can_refresh=True)
 
-        output = ''
+        if workflow not in info.return_workflows():
+            # The workflow may be newer than the errors, but this page does not wait for them
+            globalerrors.rebuild_in_background()
 
-        try:
-            if workflow not in \
-                    globalerrors.check_session(
-                            cherrypy.session, can_refresh=True).return_workflows():
-                WorkflowTools.RESET_LOCK.acquire()
-                info = globalerrors.check_session(cherrypy.session)
-                if info:
-                    info.teardown()
-                    info.setup()
-                WorkflowTools.RESET_LOCK.release()
-
-                raise cherrypy.HTTPError(404)
-
-            workflowdata = globalerrors.see_workflow(workflow, cherrypy.session)
-
-            drain_statuses = {sitename: drain for sitename, _, drain in \
-                                  sitereadiness.i_site_readiness()}
-
-            output = render(
-                'workflowtables.html',
-                workflowdata=workflowdata,
-                workflow=workflow,
-                issuggested=issuggested,
-                workflowinfo=globalerrors.check_session(cherrypy.session).get_workflow(workflow),
-                readiness=globalerrors.check_session(cherrypy.session).readiness,
-                drain_statuses=drain_statuses,
-                last_submitted=manageactions.get_datetime_submitted(workflow)
-                )
-        finally:
-            self.seeworkflowlock.release()
+            raise cherrypy.HTTPError(404)
 
-        return output
+        # Everyone viewing this workflow with the same errors gets the same page
+        return self.pages.do(('seeworkflow', workflow, issuggested, id(info)),
+                             self._render_workflow, workflow, issuggested, {'info': info})
+
+    def _render_workflow(self, workflow, issuggested, snapshot):
+        """
+        :param str workflow: is the name of the workflow to look at
+        :param str issuggested: is passed on to the template
+        :param dict snapshot: holds the ErrorInfo to read under ``'info'``,
+                              so that the whole page comes from the same errors
+        :returns: the error tables page for a given workflow
+        :rtype: str
+        """
+
+        info = globalerrors.check_session(snapshot)
+
+        return render(
+            'workflowtables.html',
+            workflowdata=globalerrors.see_workflow(workflow, snapshot),
+            workflow=workflow,
+            issuggested=issuggested,
+            workflowinfo=info.get_workflow(workflow),
+            readiness=info.readiness,
+            drain_statuses=self.drainstatuses(),
+            last_submitted=manageactions.get_datetime_submitted(workflow)
+            )
 
 
     @cherrypy.expose
@@ -469,8 +590,7 @@ class WorkflowTools(object):
         :returns: An object (dictionary) of drain statuses of sites
         :rtype: JSON
         """
-        return {sitename: drain for sitename, _, drain in \
-                    sitereadiness.i_site_readiness()}
+        return {site['site']: site['drain'] for site in self.site_statuses}
 
 
     @cherrypy.expose
@@ -481,21 +601,6 @@ class WorkflowTools(object):
         :rtype: JSON
         """
 
-        self.readinesslock.acquire()
-
-        try:
-            if self.site_statuses is None:
-                self.site_statuses = [
-                    {
-                        'site': site,
-                        'status': status,
-                        'drain': drain
-                    }
-                    for site, status, drain in sitereadiness.i_site_readiness()
-                ]
-        finally:
-            self.readinesslock.release()
-
         return self.site_statuses
 
 
@@ -524,41 +629,49 @@ class WorkflowTools(object):
     @cherrypy.tools.json_out()
     def similarwfs(self, workflow):
         """
-        Gives back a list of workflows that are clustered with the queried workflow.
-        This is just an array of strings.
-
-        :param str workflow: The workflow to find the group.
-        :returns: List of similar workflows.
-                  If the quey is not a valid workflow in the system, an empty list is returned
+        Gives back a list of workflows with errors most like the queried workflow,
+        closest first.
+        The number of workflows is set by ``neighbors`` in the ``cluster`` configuration.
+
+        :param str workflow: The workflow to find the neighbors of.
+        :returns: List of similar workflows, their distances from the queried workflow,
+                  the other workflows in its cluster,
+                  and which of them have been acted on recently.
+                  If the quey is not a valid workflow in the system, empty lists are returned
         :rtype: JSON
         """
-        output = {'similar': [], 'acted': []}
-
-        self.seeworkflowlock.acquire()
+        info = globalerrors.check_session(cherrypy.session, can_refresh=True)
 
-        try:
-            if workflow in \
-                    globalerrors.check_session(cherrypy.session,
-                                               can_refresh=True).return_workflows():
+        if workflow not in info.return_workflows():
+            return {'similar': [], 'distances': [], 'clustered': [], 'acted': []}
 
-                clusterworkflows.CLUSTER_LOCK.acquire()
+        return self.pages.do(('similarwfs', workflow, id(info)),
+                             self._similar, workflow, {'info': info})
 
-                similar_wfs = clusterworkflows.\
-                    get_clustered_group(workflow, self.clusterer, cherrypy.session)
+    def _similar(self, workflow, snapshot):
+        """
+        :param str workflow: The workflow to find the neighbors of
+        :param dict snapshot: holds the ErrorInfo to read under ``'info'``
+        :returns: The output of :py:meth:`similarwfs`
+        :rtype: dict
+        """
 
-                clusterworkflows.CLUSTER_LOCK.release()
+        neighbors = clusterworkflows.get_similar_workflows(workflow, snapshot)
 
-                acted = [
-                    wf for wf in manageactions.get_acted_workflows(
-                        serverconfig.get_history_length()) if wf in similar_wfs
-                ]
+        similar_wfs = [wf for wf, _ in neighbors]
+        # Clusters are found in the background, so this does not wait
+        clustered = clusterworkflows.get_cluster(workflow, snapshot)
 
-                output = {'similar': sorted(list(similar_wfs)),
-                          'acted': acted}
-        finally:
-            self.seeworkflowlock.release()
+        acted = [
+            wf for wf in manageactions.get_acted_workflows(
+                serverconfig.get_history_length())
+            if wf in similar_wfs or wf in clustered
+        ]
 
-        return output
+        return {'similar': similar_wfs,
+                'distances': [distance for _, distance in neighbors],
+                'clustered': clustered,
+                'acted': acted}
 
 
     @cherrypy.expose
@@ -576,24 +689,25 @@ class WorkflowTools(object):
         :rtype: JSON
         """
 
-        output = {}
-        self.seeworkflowlock.acquire()
+        return self.pages.do(('classifyerror', workflow), self._classify, workflow)
 
-        try:
-            max_error = classifyerrors.get_max_errorcode(self.get(workflow))
-            main_error_class = classifyerrors.classifyerror(max_error, self.get(workflow))
-
-            output = {
-                'maxerror': max_error,
-                'types': main_error_class[0],
-                'recommended': main_error_class[1],
-                'params': main_error_class[2]
-            }
+    def _classify(self, workflow):
+        """
+        :param str workflow: The workflow to classify
+        :returns: The output of :py:meth:`classifyerror`
+        :rtype: dict
+        """
 
-        finally:
-            self.seeworkflowlock.release()
+        wkfl_obj = self.get(workflow)
+        max_error = classifyerrors.get_max_errorcode(wkfl_obj)
+        main_error_class = classifyerrors.classifyerror(max_error, wkfl_obj)
 
-        return output
+        return {
+            'maxerror': max_error,
+            'types': main_error_class[0],
+            'recommended': main_error_class[1],
+            'params': main_error_class[2]
+        }
 
 
     @cherrypy.expose
@@ -652,12 +766,16 @@ class WorkflowTools(object):
 
         output = ''
 
-        self.seeworkflowlock.acquire()
-        try:
+        # Only submissions that share a workflow wait for each other
+        with self.submitlocks.hold(
+                workflows if isinstance(workflows, list) else [workflows]):
 
-            workflows, reasons, params = manageactions.\
-                submitaction(cherrypy.request.login, workflows, action, cherrypy.session,
-                             **kwargs)
+            try:
+                workflows, reasons, params = manageactions.\
+                    submitaction(cherrypy.request.login, workflows, action, cherrypy.session,
+                                 **kwargs)
+            except manageactions.FailedWrite as error:
+                raise cherrypy.HTTPError(500, str(error))
 
             # Immediately get actions to check the sites list
             check_actions = manageactions.get_actions()
@@ -691,9 +809,6 @@ class WorkflowTools(object):
                                 params=params,
                                 user=cherrypy.request.login)
 
-        finally:
-            self.seeworkflowlock.release()
-
         return output
 
 
@@ -896,7 +1011,7 @@ class WorkflowTools(object):
         The function is only accessible to someone with a verified account.
 
         Navigating to ``https://localhost:8080/resetcache``
-        resets the error info for the user's session.
+        resets the error info shared by all sessions.
         It also clears out cached JSON files on the server.
         Under normal operation, this cache is only refreshed every half hour.
 
@@ -922,8 +1037,7 @@ class WorkflowTools(object):
                 for pid in prepids:
                     info.prepidinfos[pid].reset()
 
-            info.teardown()
-            info.setup()
+            globalerrors.rebuild_info()
 
         WorkflowTools.RESET_LOCK.release()
 